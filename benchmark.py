@@ -0,0 +1,280 @@
+import argparse
+import copy
+import os
+import platform
+import subprocess
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+import pbp_processing
+import scheduler
+import simulation
+import sweep
+import team_probabilities
+import year_processing
+
+# Times every pipeline stage and the simulator on synthetic data, so it runs offline. Each run
+# appends to benchmark_results.csv with the commit and sizes, and prints the change against the
+# previous run of the same benchmark.
+
+results_columns = ["timestamp", "commit", "benchmark", "workers", "seasons", "games", "events_per_game",
+                   "items", "unit", "seconds", "items_per_second"]
+
+repo_dir = os.path.dirname(os.path.abspath(__file__))
+
+# One nickname per team, as it appears in team rebound descriptions ("Celtics Rebound")
+team_names = {}
+for name, abbr in year_processing.TEAM_NAME_TO_ABBR.items():
+    if abbr in simulation.actual_wins_2223 and abbr not in team_names:
+        team_names[abbr] = name.title()
+
+def synth_game(rng, gameid, home, away, season, events_per_game):
+    # Raw Kaggle-style rows: shots with blocks and rebounds (player, team and unlabelled),
+    # turnovers with steals, shooting fouls with free throws, timeouts and substitutions
+    rows = []
+    pts = {home: 0, away: 0}
+    rebounds = {}
+    players = {team: [f"{team}_P{i}" for i in range(8)] for team in (home, away)}
+    possessions = max(4, int(events_per_game / 1.8))
+
+    def add(period, clock, type_, subtype, result, team, player, desc, x=np.nan, y=np.nan, dist=np.nan, scored=False):
+        rows.append({"gameid": gameid, "period": period, "clock": clock,
+                     "h_pts": pts[home] if scored or rng.random() < 0.3 else np.nan,
+                     "a_pts": pts[away] if scored or rng.random() < 0.3 else np.nan,
+                     "team": team, "player": player, "type": type_, "subtype": subtype, "result": result,
+                     "x": x, "y": y, "dist": dist, "desc": desc, "season": season})
+
+    per_period = possessions // 4
+    offense = home if rng.random() < 0.5 else away
+    for k in range(per_period * 4):
+        period = k // per_period + 1
+        left = 720 * (1 - (k % per_period) / per_period)
+        clock = f"PT{int(left // 60):02d}M{left % 60:05.2f}S"
+        defense = away if offense == home else home
+        shooter = players[offense][rng.integers(8)]
+        if k % per_period == 0:
+            add(period, "PT12M00.00S", "period", "start", np.nan, np.nan, np.nan, "Start of period")
+            if k == 0:
+                add(period, clock, "Jump Ball", np.nan, np.nan, home, players[home][0], "Jump Ball")
+        if rng.random() < 0.05:
+            add(period, clock, "Substitution", np.nan, np.nan, offense, shooter, "SUB")
+
+        r = rng.random()
+        if r < 0.45:
+            three = rng.random() < 0.3
+            pts[offense] += 3 if three else 2
+            add(period, clock, "Made Shot", "Jump Shot", "Made", offense, shooter,
+                f"{shooter} {'3PT ' if three else ''}Jump Shot ({pts[offense]} PTS)", 1.0, 2.0, 24 if three else 10, True)
+            if rng.random() < 0.05:
+                add(period, clock, "Timeout", "Regular", np.nan, defense, np.nan, "Timeout")
+            offense = defense
+        elif r < 0.80:
+            three = rng.random() < 0.35
+            add(period, clock, "Missed Shot", "Jump Shot", "Missed", offense, shooter,
+                f"MISS {shooter} {'3PT ' if three else ''}Jump Shot", 1.5, 2.5, 24 if three else 10)
+            if rng.random() < 0.15:
+                add(period, clock, np.nan, np.nan, np.nan, defense, players[defense][1], f"{players[defense][1]} BLOCK (1 BLK)")
+            rebound_team = offense if rng.random() < 0.25 else defense
+            kind = rng.random()
+            if kind < 0.8:
+                player = players[rebound_team][rng.integers(8)]
+                off, dfn = rebounds.get(player, (0, 0))
+                off, dfn = (off + 1, dfn) if rebound_team == offense else (off, dfn + 1)
+                rebounds[player] = (off, dfn)
+                add(period, clock, "Rebound", np.nan, np.nan, rebound_team, player, f"{player} REBOUND (Off:{off} Def:{dfn})")
+            elif kind < 0.9:
+                add(period, clock, "Rebound", np.nan, np.nan, rebound_team, np.nan, f"{team_names[rebound_team]} Rebound")
+            else:
+                add(period, clock, "Rebound", np.nan, np.nan, rebound_team, np.nan, np.nan)
+            offense = rebound_team
+        elif r < 0.90:
+            if rng.random() < 0.5:
+                add(period, clock, "Turnover", "Bad Pass", np.nan, offense, shooter, f"{shooter} Bad Pass Turnover")
+                add(period, clock, np.nan, np.nan, np.nan, defense, players[defense][2], f"{players[defense][2]} STEAL (1 STL)")
+            else:
+                add(period, clock, "Turnover", "Traveling", np.nan, offense, shooter, f"{shooter} Traveling Turnover")
+            offense = defense
+        else:
+            add(period, clock, "Foul", "Shooting", np.nan, defense, players[defense][3], "Shooting Foul")
+            for j in (1, 2):
+                made = rng.random() < 0.75
+                if made:
+                    pts[offense] += 1
+                desc = f"{shooter} Free Throw {j} of 2 ({pts[offense]} PTS)" if made else f"MISS {shooter} Free Throw {j} of 2"
+                add(period, clock, "Free Throw", f"Free Throw {j} of 2", np.nan, offense, shooter, desc, scored=made)
+            offense = defense
+        if (k + 1) % per_period == 0:
+            add(period, "PT00M00.00S", "period", "end", np.nan, np.nan, np.nan, "End of period")
+    return rows
+
+def synth_season(season=2023, games=60, events_per_game=450, seed=0, teams=8):
+    # A small league keeps every team's home and away Markov tables populated at modest sizes
+    # and rounds of pairings alternate home and away so every team gets both
+    rng = np.random.default_rng([seed, season])
+    teams = sorted(team_names)[:teams]
+    pairings = []
+    while len(pairings) < games:
+        perm = rng.permutation(teams)
+        pairings += [(perm[i], perm[i + 1]) for i in range(0, len(perm) - 1, 2)]
+        pairings += [(perm[i + 1], perm[i]) for i in range(0, len(perm) - 1, 2)]
+
+    rows = []
+    for g, (home, away) in enumerate(pairings[:games]):
+        rows += synth_game(rng, season * 100000 + g, str(home), str(away), season, events_per_game)
+    return pd.DataFrame(rows)
+
+def synth_schedule(games_per_team=82, seed=0):
+    # Every team plays games_per_team games, half at home
+    rng = np.random.default_rng(seed)
+    teams = sorted(simulation.actual_wins_2223)
+    games = []
+    for _ in range(games_per_team // 2):
+        perm = rng.permutation(teams)
+        games += [(perm[i], perm[i + 1]) for i in range(0, len(perm), 2)]
+        games += [(perm[i + 1], perm[i]) for i in range(0, len(perm), 2)]
+    rng.shuffle(games)
+    return pd.DataFrame({"gameid": np.arange(len(games)),
+                         "homeTeam": [home for home, _ in games], "awayTeam": [away for _, away in games]})
+
+def current_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              cwd=repo_dir).stdout.strip() or None
+    except OSError:
+        return None
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+def bench_stages(raw_dir, seasons, workers):
+    # Each stage runs over all synthetic seasons with one scheduler task per season
+    stages = [
+        ("year_processing.parallel_process_season", lambda season: (year_processing.parallel_process_season, raw_dir, season)),
+        ("pbp_processing.process_season_pbp", lambda season: (pbp_processing.process_season_pbp, season)),
+        ("team_probabilities.generate_season_markovs", lambda season: (team_probabilities.generate_season_markovs, season)),
+    ]
+    rows = []
+    for name, make_args in stages:
+        for w in workers:
+            tasks = [scheduler.task(season, *make_args(season)) for season in seasons]
+            seconds, (results, _) = timed(scheduler.run_tasks, tasks, w, desc=name.split(".")[0])
+            if len(results) != len(tasks):
+                raise RuntimeError(f"{name} failed on some synthetic seasons")
+            rows.append({"benchmark": name, "workers": w, "items": len(seasons), "unit": "seasons", "seconds": seconds})
+    return rows
+
+def bench_process_group(raw_dir, season):
+    df = pd.read_csv(raw_dir + f"/pbp{season}.csv")
+    groups = list(df.groupby("gameid"))
+    year_processing.process_group(*groups[0])
+    seconds, _ = timed(lambda: [year_processing.process_group(gid, group) for gid, group in groups])
+    return [{"benchmark": "year_processing.process_group", "workers": 1, "items": len(groups), "unit": "games", "seconds": seconds}]
+
+def bench_simulator(workers, replicates=200, iterations=5, legacy_games=50):
+    schedule = synth_schedule()
+    meta, probs = simulation.load_team_inputs(os.path.join(repo_dir, "team_metadata.json"),
+                                              os.path.join(repo_dir, "team_matrices.json"),
+                                              os.path.join(repo_dir, "team_model.npz"))
+    teams = list(simulation.actual_wins_2223)
+    params = simulation.compile_team_params(probs, meta, teams)
+    season_schedule = simulation.compile_schedule(schedule, teams)
+    rows = []
+
+    games = schedule.head(legacy_games)
+    seconds, _ = timed(lambda: [simulation.simulate_game(home, away, home, probs[home], probs[away], meta[home], meta[away])
+                                for home, away in zip(games["homeTeam"], games["awayTeam"])])
+    rows.append({"benchmark": "simulation.simulate_game", "workers": 1, "items": legacy_games, "unit": "games", "seconds": seconds})
+
+    rng = np.random.default_rng(0)
+    simulation.simulate_season(params, season_schedule, rng)
+    seconds, _ = timed(lambda: [simulation.simulate_season(params, season_schedule, rng) for _ in range(20)])
+    rows.append({"benchmark": "simulation.simulate_season", "workers": 1, "items": 20 * len(season_schedule["home"]),
+                 "unit": "games", "seconds": seconds})
+
+    for mode in simulation.calibration_modes:
+        seconds, _ = timed(simulation.backpropagate_possessions, schedule, simulation.actual_wins_2223, meta,
+                           copy.deepcopy(probs), iterations=iterations, rng=0, mode=mode)
+        rows.append({"benchmark": f"simulation.backpropagate_possessions[{mode}]", "workers": 1, "items": iterations,
+                     "unit": "iterations", "seconds": seconds})
+
+    for w in workers:
+        seconds, _ = timed(simulation.run_replicates, replicates, seed=0, max_workers=w, schedule=schedule,
+                           meta=meta, probs=probs, batch_size=max(1, replicates // (4 * w)))
+        rows.append({"benchmark": "simulation.run_replicates", "workers": w, "items": replicates, "unit": "seasons", "seconds": seconds})
+
+        grid = sweep.sweep_grid(learn_rates=np.linspace(0.3, 0.7, 2 * w), iterations=(iterations,))
+        seconds, _ = timed(sweep.run_sweep, grid, repeats=1, seed=0, max_workers=w, schedule=schedule,
+                           meta=meta, probs=probs, patience=iterations + 1)
+        rows.append({"benchmark": "sweep.run_sweep", "workers": w, "items": len(grid) * iterations,
+                     "unit": "iterations", "seconds": seconds})
+    return rows
+
+def compare_to_previous(results, history):
+    # Ratio of this run's time to the latest earlier run with the same benchmark, workers and sizes
+    keys = ["benchmark", "workers", "seasons", "games", "events_per_game"]
+    if history is None or history.empty:
+        return results.assign(previous_seconds=np.nan, ratio=np.nan)
+    previous = history.sort_values("timestamp").groupby(keys, as_index=False).last()[keys + ["seconds"]]
+    merged = results.merge(previous.rename(columns={"seconds": "previous_seconds"}), on=keys, how="left")
+    return merged.assign(ratio=merged["seconds"] / merged["previous_seconds"])
+
+def run_benchmarks(seasons=4, games=60, events_per_game=450, workers=None, output="benchmark_results.csv",
+                   skip_pipeline=False, skip_simulator=False, seed=0):
+    workers = workers or sorted({1, scheduler.available_cpus()})
+    season_list = list(range(2023 - seasons + 1, 2024))
+    rows = []
+
+    with tempfile.TemporaryDirectory() as workdir:
+        raw_dir = os.path.join(workdir, "raw")
+        os.makedirs(raw_dir)
+        for season in season_list:
+            synth_season(season, games, events_per_game, seed).to_csv(os.path.join(raw_dir, f"pbp{season}.csv"), index=False)
+
+        # The stages read and write data/ relative to the working directory
+        if not skip_pipeline:
+            cwd = os.getcwd()
+            os.chdir(workdir)
+            try:
+                rows += bench_process_group(raw_dir, season_list[0])
+                rows += bench_stages(raw_dir, season_list, workers)
+            finally:
+                os.chdir(cwd)
+
+    if not skip_simulator:
+        rows += bench_simulator(workers)
+
+    results = pd.DataFrame(rows)
+    results["timestamp"] = pd.Timestamp.now().isoformat(timespec="seconds")
+    results["commit"] = current_commit()
+    results["seasons"] = seasons
+    results["games"] = games
+    results["events_per_game"] = events_per_game
+    results["items_per_second"] = results["items"] / results["seconds"]
+    results = results[results_columns]
+
+    history = pd.read_csv(output) if output and os.path.exists(output) else None
+    report = compare_to_previous(results, history)
+    if output:
+        results.to_csv(output, mode="a", header=history is None, index=False)
+    return report
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the pipeline stages and the simulator on synthetic seasons.")
+    parser.add_argument("--seasons", type=int, default=4)
+    parser.add_argument("--games", type=int, default=60, help="games per synthetic season")
+    parser.add_argument("--events-per-game", type=int, default=450)
+    parser.add_argument("--workers", type=int, nargs="+", help="worker counts to compare (default: 1 and all CPUs)")
+    parser.add_argument("--output", default="benchmark_results.csv")
+    parser.add_argument("--skip-pipeline", action="store_true")
+    parser.add_argument("--skip-simulator", action="store_true")
+    args = parser.parse_args()
+
+    print(f"{platform.python_version()} on {scheduler.available_cpus()} CPUs")
+    report = run_benchmarks(args.seasons, args.games, args.events_per_game, args.workers, args.output,
+                            args.skip_pipeline, args.skip_simulator)
+    print(report[["benchmark", "workers", "items", "unit", "seconds", "items_per_second", "ratio"]].to_string(index=False))
@@ -0,0 +1,212 @@
+import argparse
+import glob
+import os
+import pickle
+import subprocess
+import sys
+import time
+
+import kagglehub
+import numpy as np
+
+import pipeline
+import scheduler
+import simulation
+import stage_cache
+import storage
+import team_probabilities
+
+# Multi-node mode. Every shard (a SLURM array task, an srun/MPI rank, or a local process) picks
+# its share of the seasons or replicates from its index, runs them on its own process pool and
+# writes one file per result under data/shards. A reduce step run after all shards have finished
+# merges the files into team_matrices.json/team_metadata.json/team_model.npz or a replicate summary.
+# Shards never write to the same file, so the only requirement is a shared filesystem.
+shard_dir = os.path.join(storage.data_dir, "shards")
+
+def shard_from_env():
+    # (index, count) of this process; array tasks first, then ranks of a multi-task job step
+    if os.environ.get("SLURM_ARRAY_TASK_ID"):
+        first = int(os.environ.get("SLURM_ARRAY_TASK_MIN", 0))
+        return int(os.environ["SLURM_ARRAY_TASK_ID"]) - first, int(os.environ["SLURM_ARRAY_TASK_COUNT"])
+    for rank, size in [("OMPI_COMM_WORLD_RANK", "OMPI_COMM_WORLD_SIZE"), ("PMI_RANK", "PMI_SIZE"),
+                       ("SLURM_PROCID", "SLURM_NTASKS")]:
+        if os.environ.get(rank) and os.environ.get(size):
+            return int(os.environ[rank]), int(os.environ[size])
+    return 0, 1
+
+def assign_shards(sizes, count):
+    # Largest item to the least loaded shard; sizes maps item -> size and must match on every shard
+    loads = [0] * count
+    shards = [[] for _ in range(count)]
+    for item in sorted(sizes, key=lambda item: (-sizes[item], item)):
+        shard = loads.index(min(loads))
+        shards[shard].append(item)
+        loads[shard] += sizes[item]
+    return shards
+
+def replicate_range(n_replicates, index, count):
+    per_shard, extra = divmod(n_replicates, count)
+    start = index * per_shard + min(index, extra)
+    return start, start + per_shard + (index < extra)
+
+def season_shard_path(season, directory=None):
+    return os.path.join(directory or shard_dir, "seasons", f"season_{season}.pkl")
+
+def replicate_shard_path(n_replicates, seed, index, count, directory=None):
+    return os.path.join(directory or shard_dir, "replicates", f"seed{seed}_n{n_replicates}_{index:04d}of{count:04d}.npz")
+
+def write_atomic(path, write):
+    # write(f) fills an open binary file; a reduce that starts early sees a missing file, never a partial one
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "wb") as f:
+        write(f)
+    os.replace(path + ".tmp", path)
+
+def season_inputs(path, from_pbp):
+    # (task function and args, input path and code version) for the raw-CSV or pbp-file route
+    if from_pbp:
+        code = stage_cache.code_version("team_probabilities", "storage")
+        input_path = lambda season: storage.season_path(season, stage="pbp")
+        run = lambda season: (team_probabilities.generate_season_markovs, season)
+    else:
+        code = stage_cache.code_version(*pipeline.fused_modules)
+        input_path = lambda season: path + f"/pbp{season}.csv"
+        run = lambda season: (pipeline.process_season_fused, path, season)
+    return run, input_path, code
+
+def run_season_shard(path, seasons, index, count, from_pbp=False, max_workers=None, force=False, directory=None):
+    # Markov counts for this shard's seasons; each shard keeps its own cache manifest
+    run, input_path, code = season_inputs(path, from_pbp)
+    mine = assign_shards({season: scheduler.file_size(input_path(season)) for season in seasons}, count)[index]
+    output_path = lambda season: season_shard_path(season, directory)
+    stage = f"shard_{index:04d}of{count:04d}"
+    stale, manifest = stage_cache.stale_seasons(stage, mine, input_path, output_path, code, force,
+                                                directory=directory or shard_dir)
+    print(f"Shard {index + 1}/{count}: seasons {mine} ({len(stale)} to run)")
+
+    def on_result(season, result):
+        write_atomic(output_path(season), lambda f: pickle.dump(result, f))
+        stage_cache.record(manifest, season, input_path(season), output_path(season), code)
+        stage_cache.save_manifest(stage, manifest, directory or shard_dir)
+
+    tasks = [scheduler.task(season, *run(season), size=scheduler.file_size(input_path(season))) for season in stale]
+    results, timings = scheduler.run_tasks(tasks, max_workers, desc=f"Shard {index} seasons", on_result=on_result,
+                                           timings_path=f"logs/shard_{index:04d}_timings.csv")
+    scheduler.report_timings(timings, desc=f"Shard {index} seasons")
+    missing = [season for season in stale if season not in results]
+    if missing:
+        raise RuntimeError(f"Shard {index} failed for seasons {missing}")
+    return mine
+
+def reduce_seasons(seasons, directory=None, output_dir="."):
+    missing = [season for season in seasons if not os.path.exists(season_shard_path(season, directory))]
+    if missing:
+        raise RuntimeError(f"No shard output for seasons {missing}; rerun the shards that own them")
+    results = {}
+    for season in seasons:
+        with open(season_shard_path(season, directory), "rb") as f:
+            results[season] = pickle.load(f)
+    markovs, meta = pipeline.merge_seasons(results, seasons)
+    return pipeline.write_team_files(markovs, meta, output_dir)
+
+def run_replicate_shard(n_replicates, seed, index, count, max_workers=None, directory=None, **inputs):
+    # Replicates start..stop of the same spawned streams run_replicates uses, so the merged
+    # result does not depend on the number of shards
+    start, stop = replicate_range(n_replicates, index, count)
+    replicate_seqs = np.random.SeedSequence(seed).spawn(n_replicates)[start:stop]
+    print(f"Shard {index + 1}/{count}: replicates {start}-{stop}")
+    wins = simulation.simulate_replicates(replicate_seqs, max_workers or scheduler.available_cpus(), **inputs)
+    path = replicate_shard_path(n_replicates, seed, index, count, directory)
+    write_atomic(path, lambda f: np.savez(f, wins=wins, start=start, stop=stop))
+    return path
+
+def reduce_replicates(n_replicates, seed, directory=None, output_path=None):
+    paths = sorted(glob.glob(os.path.join(directory or shard_dir, "replicates", f"seed{seed}_n{n_replicates}_*of*.npz")))
+    counts = {int(os.path.basename(p)[-8:-4]) for p in paths}
+    if len(counts) > 1:
+        raise RuntimeError(f"Replicate shards from runs with different shard counts: {sorted(counts)}")
+    count = counts.pop() if counts else 0
+    parts = []
+    for p in paths:
+        with np.load(p) as shard:
+            parts.append((int(shard["start"]), int(shard["stop"]), shard["wins"]))
+    parts.sort(key=lambda part: part[0])
+    covered = [(start, stop) for start, stop, _ in parts]
+    expected = [replicate_range(n_replicates, i, count) for i in range(count)]
+    if not parts or covered != expected:
+        raise RuntimeError(f"Replicate shards cover {covered}, expected 0-{n_replicates} in full")
+
+    teams = list(simulation.actual_wins_2223)
+    wins = np.concatenate([w for _, _, w in parts])
+    # Same tiebreak stream as run_replicates: the child spawned after the replicate streams
+    tiebreak_rng = np.random.default_rng(np.random.SeedSequence(seed).spawn(n_replicates + 1)[n_replicates])
+    summary = simulation.summarize_replicates(wins, teams, tiebreak_rng)
+    if output_path is not None:
+        summary.to_csv(output_path)
+    return {"teams": teams, "wins": wins, "summary": summary, "entropy": seed}
+
+def run_local(argv, shards, workers=None):
+    # Runs `shards` copies of this script on one machine, then the matching reduce
+    workers = workers or max(1, scheduler.available_cpus() // shards)
+    procs = [subprocess.Popen([sys.executable, __file__, *argv, "--shard", str(i), "--shards", str(shards),
+                               "--workers", str(workers)]) for i in range(shards)]
+    failed = [i for i, proc in enumerate(procs) if proc.wait() != 0]
+    if failed:
+        raise RuntimeError(f"Shards {failed} failed")
+    command = argv.index(next(arg for arg in argv if arg in ("seasons", "replicates")))
+    subprocess.run([sys.executable, __file__, *argv[:command], "reduce-" + argv[command], *argv[command + 1:]], check=True)
+
+def without_option(argv, option):
+    # argv minus `option VALUE` / `option=VALUE`
+    out = []
+    skip = False
+    for arg in argv:
+        if skip:
+            skip = False
+        elif arg == option:
+            skip = True
+        elif not arg.startswith(option + "="):
+            out.append(arg)
+    return out
+
+def season_list(text):
+    first, _, last = text.partition("-")
+    return list(range(int(first), int(last or first) + 1))
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Shard season processing or simulation replicates across SLURM tasks.")
+    parser.add_argument("command", choices=["seasons", "reduce-seasons", "replicates", "reduce-replicates"])
+    parser.add_argument("--seasons", type=season_list, default=season_list("2015-2022"), help="e.g. 1997-2023")
+    parser.add_argument("--raw", help="directory of raw pbp{season}.csv files (default: Kaggle download)")
+    parser.add_argument("--from-pbp", action="store_true", help="build Markov counts from existing pbp stage files")
+    parser.add_argument("--replicates", type=int, default=1000)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--shard", type=int, help="this shard's index (default: from SLURM/MPI environment)")
+    parser.add_argument("--shards", type=int, help="number of shards (default: from SLURM/MPI environment)")
+    parser.add_argument("--workers", type=int, help="processes per shard (default: all available CPUs)")
+    parser.add_argument("--local", type=int, metavar="N", help="run N shards as local processes, then reduce")
+    parser.add_argument("--output", default="replicate_summary.csv", help="replicate summary written by reduce-replicates")
+    parser.add_argument("--force", action="store_true")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    if args.local:
+        run_local(without_option(without_option(sys.argv[1:], "--local"), "--workers"), args.local, args.workers)
+    elif args.command.startswith("reduce"):
+        if args.command == "reduce-seasons":
+            reduce_seasons(args.seasons)
+        else:
+            result = reduce_replicates(args.replicates, args.seed, output_path=args.output)
+            print(result["summary"].sort_values("mean_wins", ascending=False).to_string(float_format=lambda x: f"{x:.2f}"))
+    else:
+        index, count = shard_from_env()
+        index = index if args.shard is None else args.shard
+        count = count if args.shards is None else args.shards
+        if args.command == "seasons":
+            path = None
+            if not args.from_pbp:
+                path = args.raw or kagglehub.dataset_download("szymonjwiak/nba-play-by-play-data-1997-2023")
+            run_season_shard(path, args.seasons, index, count, args.from_pbp, args.workers, args.force)
+        else:
+            run_replicate_shard(args.replicates, args.seed, index, count, args.workers)
+    print("Done in", round(time.time() - start_time, 2), "seconds.")
@@ -0,0 +1,152 @@
+import cProfile
+import functools
+import glob
+import json
+import os
+import pstats
+import resource
+import sys
+import time
+from contextlib import contextmanager
+from multiprocessing import util
+
+import pandas as pd
+
+# Opt-in timing for the pipeline. Set PBP_INSTRUMENT to a directory (or 1 for logs/instrument) and
+# every @step function and span() block appends a record to events_<pid>.jsonl there; worker
+# processes inherit the setting. PBP_PROFILE=1 also runs cProfile in each process and writes
+# profile_<pid>.prof. report() merges everything into report.json and a printed summary.
+directory = os.environ.get("PBP_INSTRUMENT", "")
+if directory == "1":
+    directory = os.path.join("logs", "instrument")
+enabled = bool(directory)
+profiling = enabled and os.environ.get("PBP_PROFILE", "") not in ("", "0")
+
+_profiler = None
+_profiler_pid = None
+
+def configure(path=None, profile=False):
+    # Turns instrumentation on from code; set before worker pools are created so they inherit it
+    global directory, enabled, profiling
+    directory = path or os.path.join("logs", "instrument")
+    enabled, profiling = True, profile
+    os.environ["PBP_INSTRUMENT"] = directory
+    os.environ["PBP_PROFILE"] = "1" if profile else "0"
+
+def reset():
+    # Clears records from previous runs
+    for path in glob.glob(os.path.join(directory, "events_*.jsonl")) + glob.glob(os.path.join(directory, "profile_*.prof")):
+        os.remove(path)
+
+def _rows(obj):
+    # Rows of a DataFrame/array, or of the first element of a returned tuple
+    if isinstance(obj, tuple) and obj:
+        obj = obj[0]
+    shape = getattr(obj, "shape", None)
+    return int(shape[0]) if shape else None
+
+def _peak_rss():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def _dump_profile():
+    if _profiler is not None:
+        _profiler.disable()
+        _profiler.dump_stats(os.path.join(directory, f"profile_{os.getpid()}.prof"))
+
+def _start_profiler():
+    global _profiler, _profiler_pid
+    if _profiler_pid != os.getpid():
+        if _profiler is not None:
+            # Inherited from the parent through fork
+            _profiler.disable()
+        _profiler = cProfile.Profile()
+        _profiler.enable()
+        _profiler_pid = os.getpid()
+        # Pool workers leave through multiprocessing's exit handlers rather than atexit
+        util.Finalize(None, _dump_profile, exitpriority=10)
+
+def record(name, wall, cpu, rows_in=None, rows_out=None, **extra):
+    os.makedirs(directory, exist_ok=True)
+    entry = {"name": name, "pid": os.getpid(), "wall": wall, "cpu": cpu, "rows_in": rows_in,
+             "rows_out": rows_out, "peak_rss": _peak_rss(), **extra}
+    with open(os.path.join(directory, f"events_{os.getpid()}.jsonl"), "a") as f:
+        f.write(json.dumps(entry, default=str) + "\n")
+
+@contextmanager
+def span(name, rows_in=None, **extra):
+    # with span("stage.part") as s: ... s["rows_out"] = len(df)
+    if not enabled:
+        yield {}
+        return
+    if profiling:
+        _start_profiler()
+    info = {"rows_in": rows_in, "rows_out": None, **extra}
+    wall, cpu = time.perf_counter(), time.process_time()
+    try:
+        yield info
+    finally:
+        record(name, time.perf_counter() - wall, time.process_time() - cpu, **info)
+
+def step(fn):
+    # Records every call of fn, with rows in taken from the first argument and rows out from the result
+    name = f"{fn.__module__}.{fn.__qualname__}"
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if not enabled:
+            return fn(*args, **kwargs)
+        with span(name, rows_in=_rows(args[0]) if args else None) as info:
+            result = fn(*args, **kwargs)
+            info["rows_out"] = _rows(result)
+        return result
+    return wrapper
+
+def load_events(path=None):
+    rows = []
+    for events in glob.glob(os.path.join(path or directory, "events_*.jsonl")):
+        with open(events) as f:
+            rows += [json.loads(line) for line in f if line.strip()]
+    return pd.DataFrame(rows)
+
+def summarize(events):
+    grouped = events.groupby("name", sort=False)
+    summary = pd.DataFrame({
+        "calls": grouped.size(),
+        "processes": grouped["pid"].nunique(),
+        "wall_total": grouped["wall"].sum(),
+        "wall_mean": grouped["wall"].mean(),
+        "wall_max": grouped["wall"].max(),
+        "cpu_total": grouped["cpu"].sum(),
+        "rows_in": grouped["rows_in"].sum(min_count=1),
+        "rows_out": grouped["rows_out"].sum(min_count=1),
+        "peak_rss_mb": grouped["peak_rss"].max() / 2 ** 20,
+    })
+    return summary.sort_values("wall_total", ascending=False)
+
+def report(path=None, top=25):
+    # Merges every process's records (and profiles) into report.json and prints the summary
+    path = path or directory
+    if _profiler_pid == os.getpid():
+        _dump_profile()
+    events = load_events(path)
+    if events.empty:
+        print(f"No instrumentation records in {path}")
+        return None
+
+    summary = summarize(events)
+    profiles = glob.glob(os.path.join(path, "profile_*.prof"))
+    out = {"processes": int(events["pid"].nunique()),
+           "steps": summary.reset_index().to_dict(orient="records"),
+           "profiles": len(profiles)}
+    with open(os.path.join(path, "report.json"), "w") as f:
+        json.dump(out, f, indent=2, default=float)
+
+    print(f"{len(events)} records from {out['processes']} processes")
+    print(summary.to_string(float_format=lambda x: f"{x:,.3f}"))
+    if profiles:
+        stats = pstats.Stats(*profiles, stream=sys.stdout)
+        stats.dump_stats(os.path.join(path, "merged.prof"))
+        stats.sort_stats("cumulative").print_stats(top)
+    return summary
@@ -1,7 +1,11 @@
 import pandas as pd
-from concurrent.futures import as_completed, ProcessPoolExecutor, ThreadPoolExecutor
-from tqdm import tqdm
+import numpy as np
 import time
+from numba import njit
+import storage
+import stage_cache
+import instrument
+import scheduler
 
 eventType = {
     "Jump Ball" : {
@@ -148,51 +152,70 @@ eventType = {
     "Steal" : "Steal",
 }
 
+@instrument.step
 def get_home_away(df):
-    def deduce_home_away(row, gameTeamsDF):
-        scoringTeam = row['team']
-        gameid = row['gameid']
-        allTeams = gameTeamsDF[gameid]
-        otherTeam = next(team for team in allTeams if team != scoringTeam)
-    
-        if row['h_pts'] > 0:
-            return pd.Series({'homeTeam': scoringTeam, 'awayTeam': otherTeam})
-        else:
-            return pd.Series({'homeTeam': otherTeam, 'awayTeam': scoringTeam})
-        
-    gameTeamsDF = df[['gameid', 'team']].drop_duplicates().dropna(subset=['team']).groupby('gameid')['team'].apply(list).to_dict()
-    
+    gameTeams = df[['gameid', 'team']].drop_duplicates().dropna(subset=['team'])
+
     scoringPlays = df[(df['h_pts'] > 0) | (df['a_pts'] > 0)].copy()
     scoringPlays = scoringPlays.sort_values(['gameid', 'Unnamed: 0'])
     firstScores = scoringPlays.groupby('gameid').first().reset_index()
-    
-    homeAway = firstScores.apply(lambda row: deduce_home_away(row, gameTeamsDF), axis=1)
-    homeAway['gameid'] = firstScores['gameid']
+
+    # The other team is the first team seen in the game that did not score first
+    others = firstScores[['gameid', 'team']].merge(gameTeams, on='gameid', how='left', suffixes=('', '_other'))
+    others = others[others['team_other'] != others['team']].drop_duplicates(subset=['gameid'])
+    firstScores = firstScores.merge(others[['gameid', 'team_other']], on='gameid', how='left')
+
+    homeScored = (firstScores['h_pts'] > 0).to_numpy()
+    homeAway = pd.DataFrame({
+        'homeTeam': np.where(homeScored, firstScores['team'], firstScores['team_other']),
+        'awayTeam': np.where(homeScored, firstScores['team_other'], firstScores['team']),
+        'gameid': firstScores['gameid'],
+    })
     df = df.merge(homeAway, on='gameid', how='left')
     return df 
 
+@instrument.step
 def set_ft_result(df):
     new_df = df.copy()
-    def get_ft_result(row):
-        if row["type"] == "Free Throw" and "PTS" in row["desc"]:
-            return "Made"
-        elif row["type"] == "Free Throw":
-            return "Missed"
-        else:
-            return row["result"]
-    new_df["result"] = df.apply(get_ft_result, axis=1)
+    is_ft = (df["type"] == "Free Throw").to_numpy()
+    is_made = is_ft & df["desc"].str.contains("PTS", regex=False, na=False).to_numpy()
+    new_df["result"] = np.select([is_made, is_ft], ["Made", "Missed"], df["result"].to_numpy(dtype=object))
     return new_df
 
+@instrument.step
 def set_jumpball_subtype(df):
     new_df = df.copy()
-    def get_jumpball_subtype(row):
-        if row["type"] == "Jump Ball":
-            return "Home Won" if row["result"] == row["homeTeam"] else "Away Won"
-        else:
-            return row["subtype"]
-    new_df["subtype"] = new_df.apply(get_jumpball_subtype, axis=1)
+    is_jumpball = (new_df["type"] == "Jump Ball").to_numpy()
+    winner = np.where(new_df["result"] == new_df["homeTeam"], "Home Won", "Away Won")
+    new_df["subtype"] = np.where(is_jumpball, winner, new_df["subtype"].to_numpy(dtype=object))
     return new_df
     
+def interleave_rows(df, keep, source, event_index):
+    # Rows `keep` of df plus copies of rows `source` with new EventIndex values, in the order a stable
+    # sort by gameid, EventIndex of the two concatenated would give, applied with a single take.
+    # df must be sorted by gameid, EventIndex, and the new rows in that order too.
+    gameid = df["gameid"].to_numpy()
+    ei = df["EventIndex"].to_numpy(dtype=float)
+    game_rank = np.concatenate([[0], np.cumsum(gameid[1:] != gameid[:-1])]) if len(df) else np.zeros(0, dtype=int)
+    low = ei.min() if len(df) else 0.0
+    span = (ei.max() - low + 2) if len(df) else 1.0
+    keys = game_rank[keep] * span + (ei[keep] - low)
+    new_keys = game_rank[source] * span + (event_index - low)
+
+    new_at = np.searchsorted(keys, new_keys, side="right") + np.arange(len(source))
+    is_new = np.zeros(len(keep) + len(source), dtype=bool)
+    is_new[new_at] = True
+    order = np.empty(len(is_new), dtype=np.intp)
+    order[~is_new] = keep
+    order[is_new] = source
+
+    out = df.take(order).reset_index(drop=True)
+    values = out["EventIndex"].to_numpy(dtype=float, copy=True)
+    values[is_new] = event_index
+    out["EventIndex"] = values
+    return out, is_new
+
+@instrument.step
 def add_inbounds(df):
     is_made_shot = df["type"] == "Made Shot"
     is_turnover = df["type"] == "Turnover"
@@ -243,107 +266,88 @@ def add_inbounds(df):
     )
     valid_timeout = is_timeout & ~timeout_after_shooting_foul
     ends_with_inbound = is_dead_ball_turnover | is_final_free_throw | valid_timeout | is_deadball_foul | valid_made_shot
-    
-    inbound_rows = df[ends_with_inbound].copy()
-    
-    inbound_rows["type"] = "Inbound"
-    inbound_rows["team"] = pd.NA
-    inbound_rows["subtype"] = pd.NA
-    inbound_rows["player"] = pd.NA
-    inbound_rows["EventIndex"] = inbound_rows["EventIndex"] + 0.1  # So they sort after the original event
-    inbound_rows["desc"] = "Inbound pass"
-    
-    df_with_inbounds = pd.concat([df, inbound_rows], ignore_index=True)
-    df = df_with_inbounds.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
+
+    # An Inbound row goes right after each event that ends with one (EventIndex + 0.1)
+    source = np.flatnonzero(ends_with_inbound.to_numpy())
+    df, is_new = interleave_rows(df, np.arange(len(df)), source, df["EventIndex"].to_numpy(dtype=float)[source] + 0.1)
+    df["type"] = df["type"].mask(is_new, "Inbound")
+    df["desc"] = df["desc"].mask(is_new, "Inbound pass")
+    for col in ["team", "subtype", "player"]:
+        values = df[col].to_numpy(dtype=object, copy=True)
+        values[is_new] = pd.NA
+        df[col] = pd.Series(values, dtype=object)
     return df
 
+@instrument.step
 def set_inbound_team(df):
     new_df = df.copy()
-    def get_inbound_team(row, past_team):
-        previous_team = past_team.loc[row.name]
-        return row["homeTeam"] if previous_team != row["homeTeam"] else row["awayTeam"]
     past_team = new_df["team"].shift(1)
-    new_df.loc[new_df["type"] == "Inbound", "team"] = new_df[new_df["type"] == "Inbound"].apply(lambda row: get_inbound_team(row, past_team), axis=1)
+    is_inbound = new_df["type"] == "Inbound"
+    inbound_team = np.where(past_team != new_df["homeTeam"], new_df["homeTeam"], new_df["awayTeam"])
+    new_df.loc[is_inbound, "team"] = inbound_team[is_inbound.to_numpy()]
     return new_df
  
+@instrument.step
 def set_shot_type(df):
     new_df = df.copy()
-    def get_shot_type(row):
-        if isinstance(row["desc"], str) and isinstance(row["type"], str):
-            if "3PT" in row["desc"] and row["type"] == "Made Shot":
-                return "3PT Made"
-            elif "3PT" in row["desc"] and row["type"] == "Missed Shot":
-                return "3PT Missed"
-            elif row["type"] == "Made Shot":
-                return "2PT Made"
-            elif row["type"] == "Missed Shot":
-                return "2PT Missed"
-            else:
-                return row["type"]
-        else:
-            return row["type"]
-    new_df["type"] = new_df.apply(get_shot_type, axis=1)
+    has_text = (new_df["desc"].notna() & new_df["type"].notna()).to_numpy()
+    is_3pt = has_text & new_df["desc"].str.contains("3PT", regex=False, na=False).to_numpy()
+    is_made = has_text & (new_df["type"] == "Made Shot").to_numpy()
+    is_missed = has_text & (new_df["type"] == "Missed Shot").to_numpy()
+    new_df["type"] = np.select(
+        [is_3pt & is_made, is_3pt & is_missed, is_made, is_missed],
+        ["3PT Made", "3PT Missed", "2PT Made", "2PT Missed"],
+        new_df["type"].to_numpy(dtype=object)
+    )
     return new_df
     
+@instrument.step
 def fix_free_throw_sequences(df):
-    df = df.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
-    df["row_idx"] = df.index
-
-    # Identify Free Throw 1 of 2 and 2 of 2 rows
-    ft1s = df[(df["type"] == "Free Throw") & (df["subtype"] == "Free Throw 1 of 2")][["gameid", "team", "row_idx", "EventIndex"]].copy()
-    ft2s = df[(df["type"] == "Free Throw") & (df["subtype"] == "Free Throw 2 of 2")][["gameid", "team", "row_idx"]].copy()
-
-    # Rename for merge clarity
-    ft1s = ft1s.rename(columns={"row_idx": "ft1_idx", "EventIndex": "ft1_EventIndex"})
-    ft2s = ft2s.rename(columns={"row_idx": "ft2_idx"})
-
-    # Use merge_asof to find the first FT2 after FT1 (within same game + team)
+    # df is sorted by gameid, EventIndex. Each Free Throw 1 of 2 is matched to the next 2 of 2 by the
+    # same team; the rows between them are dropped and the 2 of 2 moves up to EventIndex + 0.01.
+    df = df.reset_index(drop=True)
+    is_ft = (df["type"] == "Free Throw").to_numpy()
+    ft1s = df.loc[is_ft & (df["subtype"] == "Free Throw 1 of 2").to_numpy(), ["gameid", "team"]]
+    ft2s = df.loc[is_ft & (df["subtype"] == "Free Throw 2 of 2").to_numpy(), ["gameid", "team"]]
     ft1_ft2 = pd.merge_asof(
-        ft1s.sort_values("ft1_idx"),
-        ft2s.sort_values("ft2_idx"),
+        ft1s.assign(ft1_idx=ft1s.index),
+        ft2s.assign(ft2_idx=ft2s.index),
         by=["gameid", "team"],
         left_on="ft1_idx",
         right_on="ft2_idx",
         direction="forward"
-    )
+    ).dropna(subset=["ft2_idx"])
+    ft1_idx = ft1_ft2["ft1_idx"].to_numpy(dtype=np.intp)
+    ft2_idx = ft1_ft2["ft2_idx"].to_numpy(dtype=np.intp)
 
-    # Drop rows in between each FT1 and its matching FT2
-    to_drop = (
-        ft1_ft2[ft1_ft2["ft2_idx"].notna()]
-        .apply(lambda row: list(range(int(row["ft1_idx"]) + 1, int(row["ft2_idx"]))), axis=1)
-        .explode()
-        .dropna()
-        .astype(int)
-        .tolist()
-    )
-
-    # Also drop the original FT2
-    to_drop += ft1_ft2["ft2_idx"].dropna().astype(int).tolist()
-
-    # Prepare FT2s to be reinserted right after FT1s
-    new_ft2_rows = df.loc[ft1_ft2["ft2_idx"].dropna().astype(int)].copy().reset_index(drop=True)
-    new_ft2_rows["EventIndex"] = ft1_ft2["ft1_EventIndex"].reset_index(drop=True) + 0.01
+    # Rows strictly inside any FT1..FT2 interval, plus the matched FT2s themselves
+    bounds = np.zeros(len(df) + 1, dtype=np.intp)
+    np.add.at(bounds, ft1_idx + 1, 1)
+    np.add.at(bounds, ft2_idx, -1)
+    dropped = np.cumsum(bounds[:-1]) > 0
+    dropped[ft2_idx] = True
 
-    # Drop the bad rows and insert the fixed FT2s
-    df = df.drop(index=to_drop).reset_index(drop=True)
-    df = pd.concat([df, new_ft2_rows], ignore_index=True)
-    df = df.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
+    event_index = df["EventIndex"].to_numpy(dtype=float)
+    df, _ = interleave_rows(df, np.flatnonzero(~dropped), ft2_idx, event_index[ft1_idx] + 0.01)
+    return df
 
-    return df.drop(columns="row_idx")
+# eventType flattened into one lookup for plain types and one keyed by "type|subtype"
+eventTypeByType = {t: v for t, v in eventType.items() if isinstance(v, str)}
+eventTypeByPair = {f"{t}|{st}": v for t, sub in eventType.items() if isinstance(sub, dict) for st, v in sub.items()}
 
+@instrument.step
 def set_event_type(df):
     new_df = df.copy()
-    def get_event_type(row):
-        if row["type"] in eventType and isinstance(eventType[row["type"]], str):
-            return eventType[row["type"]]
-        elif row["type"] in eventType and row["subtype"] in eventType[row["type"]]:
-            return eventType[row["type"]][row["subtype"]]
-        else:
-            print(row["type"], row["subtype"])
     new_df = new_df[~((new_df["type"].isna()) & (new_df["subtype"].isna()))]
-    new_df["eventType"] = new_df.apply(get_event_type, axis=1)
+    by_type = new_df["type"].map(eventTypeByType)
+    by_pair = (new_df["type"].astype(str) + "|" + new_df["subtype"].astype(str)).map(eventTypeByPair)
+    events = by_type.where(by_type.notna(), by_pair)
+    for t, st in zip(new_df.loc[events.isna(), "type"], new_df.loc[events.isna(), "subtype"]):
+        print(t, st)
+    new_df["eventType"] = events.astype(object).where(events.notna(), None)
     return new_df
      
+@instrument.step
 def update_blocks_steals_charges(df):
     new_df = df.copy()
     
@@ -362,6 +366,7 @@ def update_blocks_steals_charges(df):
     
     return new_df
 
+@instrument.step
 def set_possession_change(df):
     new_df = df.copy()
     new_df["possessionChange"] = pd.NA
@@ -387,42 +392,51 @@ def set_possession_change(df):
     new_df.loc[~is_possession_change, "possessionChange"] = False
     return new_df
     
-def set_game_possession_team(game_id, game_df):
-    possession_col = pd.Series(pd.NA, index=game_df.index, dtype="object")
-
-    last_team = None
-    possession_change = (game_df["possessionChange"] == True) & (game_df["type"] != "Jump Ball")
-
-    for i in game_df.index:
-        event = game_df.at[i, "eventType"]
-        if event == "Home Won Jump Ball":
-            last_team = game_df.at[i, "homeTeam"]
-        elif event == "Away Won Jump Ball":
-            last_team = game_df.at[i, "awayTeam"]
-        elif possession_change[i] and last_team:
-            last_team = (
-                game_df.at[i, "awayTeam"]
-                if last_team == game_df.at[i, "homeTeam"]
-                else game_df.at[i, "homeTeam"]
-            )
-        if last_team:
-            possession_col.at[i] = last_team
-    return possession_col
+@njit(cache=True)
+def possession_team_codes(game_codes, event_codes, possession_change, home_codes, away_codes):
+    # -2 means no possession yet in this game, -1 a missing team name
+    codes = np.full(len(game_codes), -2, dtype=np.int64)
+    last_team = -2
+    for i in range(len(game_codes)):
+        if i == 0 or game_codes[i] != game_codes[i - 1]:
+            last_team = -2
+        if event_codes[i] == 1:
+            last_team = home_codes[i]
+        elif event_codes[i] == 2:
+            last_team = away_codes[i]
+        elif possession_change[i] and last_team != -2:
+            if last_team >= 0 and last_team == home_codes[i]:
+                last_team = away_codes[i]
+            else:
+                last_team = home_codes[i]
+        codes[i] = last_team
+    return codes
 
+@instrument.step
 def set_possession_team(df):
     new_df = df.copy()
-    new_df["possessionTeam"] = pd.NA
 
-    grouped = list(new_df.groupby("gameid"))
+    game_codes, _ = pd.factorize(new_df["gameid"])
+    order = np.argsort(game_codes, kind="stable")
+    team_codes, teams = pd.factorize(pd.concat([new_df["homeTeam"], new_df["awayTeam"]]))
+    home_codes, away_codes = team_codes[:len(new_df)], team_codes[len(new_df):]
+    event_codes = np.select(
+        [new_df["eventType"] == "Home Won Jump Ball", new_df["eventType"] == "Away Won Jump Ball"], [1, 2], 0
+    )
+    possession_change = ((new_df["possessionChange"] == True) & (new_df["type"] != "Jump Ball")).to_numpy()
+
+    codes = np.empty(len(new_df), dtype=np.int64)
+    codes[order] = possession_team_codes(
+        game_codes[order], event_codes[order], possession_change[order], home_codes[order], away_codes[order]
+    )
 
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = {executor.submit(set_game_possession_team, gid, gdf): gid for gid, gdf in grouped}
-        for future in as_completed(futures):
-            possession_result = future.result()
-            new_df.loc[possession_result.index, "possessionTeam"] = possession_result
-            
+    possession_team = np.full(len(new_df), pd.NA, dtype=object)
+    possession_team[codes == -1] = np.nan
+    possession_team[codes >= 0] = np.asarray(teams, dtype=object)[codes[codes >= 0]]
+    new_df["possessionTeam"] = possession_team
     return new_df
 
+@instrument.step
 def set_possession_id(df):
     new_df = df.copy()
     new_df["possessionId"] = (
@@ -430,9 +444,8 @@ def set_possession_id(df):
     ).cumsum()
     return new_df
 
-def process_season_pbp(season):
-    df = pd.read_csv(f"data/pbp_{season}.csv")
-    
+@instrument.step
+def transform_season_pbp(df):
     df["type"] = df["type"].str.strip()
     
     df = set_jumpball_subtype(
@@ -489,17 +502,64 @@ def process_season_pbp(season):
         "y" : "Y",
         "dist" : "shotDistance"
         })
+    return df
+
+def transform_games_stream(batches):
+    # Batches hold complete games in gameid order. Each is transformed with the game before and after
+    # it attached, so the shifted windows see the same rows as in a whole-season run, and the
+    # possession ids continue from the previous batch.
+    batches = (batch for batch in batches if len(batch))
+    previous_game = None
+    current = next(batches, None)
+    possession_offset = 0
+    index_offset = 0
+    while current is not None:
+        following = next(batches, None)
+        next_game = None if following is None else following[following["gameid"] == following["gameid"].iloc[0]]
+        frame = pd.concat([f for f in (previous_game, current, next_game) if f is not None], ignore_index=True)
+
+        df = transform_season_pbp(frame)
+        df = df[df["gameid"].isin(current["gameid"].unique())]
+        if len(df):
+            df["possessionId"] = df["possessionId"] - df["possessionId"].iloc[0] + 1 + possession_offset
+            df.index = df.index - df.index[0] + index_offset
+            possession_offset = df["possessionId"].iloc[-1]
+            index_offset = df.index[-1] + 1
+            yield df
+
+        previous_game = current[current["gameid"] == current["gameid"].iloc[-1]]
+        current = following
+
+@instrument.step
+def process_season_pbp(season):
+    df = storage.read_season(season, stage="clean", categorical=False)
+    df = transform_season_pbp(df)
+    storage.write_season(df, season)
     
-    df.to_csv(f"data/pbp_{season}.csv")
-    
-def parallel_main():
+def parallel_main(force=False, max_workers=None):
     seasons = list(range(1997, 2024))
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_season_pbp, season) for season in seasons]
-        for f in tqdm(as_completed(futures), total=len(futures), desc="Seasons"):
-            pass
+
+    # Only seasons whose clean file or this stage's code changed since the last run are reprocessed
+    code = stage_cache.code_version("pbp_processing", "storage")
+    input_path = lambda season: storage.season_path(season, stage="clean")
+    output_path = lambda season: storage.season_path(season, stage="pbp")
+    seasons, manifest = stage_cache.stale_seasons("pbp", seasons, input_path, output_path, code, force)
+
+    def on_result(season, result):
+        stage_cache.record(manifest, season, input_path(season), output_path(season), code)
+        stage_cache.save_manifest("pbp", manifest)
+
+    tasks = [scheduler.task(season, process_season_pbp, season, size=scheduler.file_size(input_path(season)))
+             for season in seasons]
+    _, timings = scheduler.run_tasks(tasks, max_workers, desc="Seasons", on_result=on_result,
+                                     timings_path="logs/pbp_processing_timings.csv")
+    scheduler.report_timings(timings, desc="Seasons")
 
 if __name__ == "__main__":
     start_time = time.time()
+    if instrument.enabled:
+        instrument.reset()
     parallel_main()
     print(time.time() - start_time)
+    if instrument.enabled:
+        instrument.report()
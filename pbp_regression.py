@@ -0,0 +1,283 @@
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from unittest import mock
+import pandas as pd
+import pbp_processing
+from pbp_processing import eventType
+import storage
+
+# Row-wise and sort-based implementations that pbp_processing replaced with column operations. They are kept
+# here only so the vectorized pipeline can be checked against them season by season.
+
+def legacy_get_home_away(df):
+    def deduce_home_away(row, gameTeamsDF):
+        scoringTeam = row['team']
+        gameid = row['gameid']
+        allTeams = gameTeamsDF[gameid]
+        otherTeam = next(team for team in allTeams if team != scoringTeam)
+    
+        if row['h_pts'] > 0:
+            return pd.Series({'homeTeam': scoringTeam, 'awayTeam': otherTeam})
+        else:
+            return pd.Series({'homeTeam': otherTeam, 'awayTeam': scoringTeam})
+        
+    gameTeamsDF = df[['gameid', 'team']].drop_duplicates().dropna(subset=['team']).groupby('gameid')['team'].apply(list).to_dict()
+    
+    scoringPlays = df[(df['h_pts'] > 0) | (df['a_pts'] > 0)].copy()
+    scoringPlays = scoringPlays.sort_values(['gameid', 'Unnamed: 0'])
+    firstScores = scoringPlays.groupby('gameid').first().reset_index()
+    
+    homeAway = firstScores.apply(lambda row: deduce_home_away(row, gameTeamsDF), axis=1)
+    homeAway['gameid'] = firstScores['gameid']
+    df = df.merge(homeAway, on='gameid', how='left')
+    return df 
+
+def legacy_set_ft_result(df):
+    new_df = df.copy()
+    def get_ft_result(row):
+        if row["type"] == "Free Throw" and "PTS" in row["desc"]:
+            return "Made"
+        elif row["type"] == "Free Throw":
+            return "Missed"
+        else:
+            return row["result"]
+    new_df["result"] = df.apply(get_ft_result, axis=1)
+    return new_df
+
+
+def legacy_set_jumpball_subtype(df):
+    new_df = df.copy()
+    def get_jumpball_subtype(row):
+        if row["type"] == "Jump Ball":
+            return "Home Won" if row["result"] == row["homeTeam"] else "Away Won"
+        else:
+            return row["subtype"]
+    new_df["subtype"] = new_df.apply(get_jumpball_subtype, axis=1)
+    return new_df
+    
+
+def legacy_add_inbounds(df):
+    is_made_shot = df["type"] == "Made Shot"
+    is_turnover = df["type"] == "Turnover"
+    not_followed_by_steal = ~(
+        (df["next_type"] == "Steal") &
+        (df["next_team"] != df["team"]) &
+        (df["gameid"] == df["next_gameid"])
+    )
+    is_dead_ball_turnover = is_turnover & not_followed_by_steal
+    is_final_free_throw = (
+        (df["type"] == "Free Throw") &
+        (df["subtype"].isin([
+            "Free Throw 2 of 2",
+            "Free Throw 3 of 3",
+            "Free Throw 1 of 1",
+            "Free Throw Flagrant 3 of 3",
+            "Free Throw Flagrant 2 of 2",
+            "Free Throw Clear Path 2 of 2",
+            "Free Throw Technical 2 of 2",
+        ])) & (df["result"] == "Made")
+    )
+    is_timeout = df["type"] == "Timeout"
+    is_deadball_foul = ((df["type"] == "Foul") & ((df["subtype"] == "Offensive") | (df["subtype"] == "Personal")))
+    is_and1 = (
+        (df["next_type"] == "Foul") &
+        (df["next_subtype"] == "Shooting") &
+        (df["next2_subtype"] == "Free Throw 1 of 1")
+    )
+    timeout_then_foul = (
+        (df["next_type"] == "Timeout") &
+        (df["next2_type"] == "Foul") &
+        (df["next2_team"] != df["team"]) &
+        (df["next2_subtype"] == "Shooting")
+    )
+    is_and1_case = is_and1 | timeout_then_foul
+    made_shot_followed_by_timeout = (
+        (df["next_type"] == "Timeout") &
+        (df["next_gameid"] == df["gameid"])
+    )
+    valid_made_shot = (
+        is_made_shot &
+        ~is_and1_case &
+        ~made_shot_followed_by_timeout
+    )
+    timeout_after_shooting_foul = (
+        (df["type"] == "Timeout") &
+        ((df["type"].shift(1) == "Foul") & (df["subtype"].shift(1) == "Shooting"))
+    )
+    valid_timeout = is_timeout & ~timeout_after_shooting_foul
+    ends_with_inbound = is_dead_ball_turnover | is_final_free_throw | valid_timeout | is_deadball_foul | valid_made_shot
+    
+    inbound_rows = df[ends_with_inbound].copy()
+    
+    inbound_rows["type"] = "Inbound"
+    inbound_rows["team"] = pd.NA
+    inbound_rows["subtype"] = pd.NA
+    inbound_rows["player"] = pd.NA
+    inbound_rows["EventIndex"] = inbound_rows["EventIndex"] + 0.1  # So they sort after the original event
+    inbound_rows["desc"] = "Inbound pass"
+    
+    df_with_inbounds = pd.concat([df, inbound_rows], ignore_index=True)
+    df = df_with_inbounds.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
+    return df
+
+def legacy_set_inbound_team(df):
+    new_df = df.copy()
+    def get_inbound_team(row, past_team):
+        previous_team = past_team.loc[row.name]
+        return row["homeTeam"] if previous_team != row["homeTeam"] else row["awayTeam"]
+    past_team = new_df["team"].shift(1)
+    new_df.loc[new_df["type"] == "Inbound", "team"] = new_df[new_df["type"] == "Inbound"].apply(lambda row: get_inbound_team(row, past_team), axis=1)
+    return new_df
+ 
+def legacy_set_shot_type(df):
+    new_df = df.copy()
+    def get_shot_type(row):
+        if isinstance(row["desc"], str) and isinstance(row["type"], str):
+            if "3PT" in row["desc"] and row["type"] == "Made Shot":
+                return "3PT Made"
+            elif "3PT" in row["desc"] and row["type"] == "Missed Shot":
+                return "3PT Missed"
+            elif row["type"] == "Made Shot":
+                return "2PT Made"
+            elif row["type"] == "Missed Shot":
+                return "2PT Missed"
+            else:
+                return row["type"]
+        else:
+            return row["type"]
+    new_df["type"] = new_df.apply(get_shot_type, axis=1)
+    return new_df
+    
+
+def legacy_fix_free_throw_sequences(df):
+    df = df.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
+    df["row_idx"] = df.index
+
+    # Identify Free Throw 1 of 2 and 2 of 2 rows
+    ft1s = df[(df["type"] == "Free Throw") & (df["subtype"] == "Free Throw 1 of 2")][["gameid", "team", "row_idx", "EventIndex"]].copy()
+    ft2s = df[(df["type"] == "Free Throw") & (df["subtype"] == "Free Throw 2 of 2")][["gameid", "team", "row_idx"]].copy()
+
+    # Rename for merge clarity
+    ft1s = ft1s.rename(columns={"row_idx": "ft1_idx", "EventIndex": "ft1_EventIndex"})
+    ft2s = ft2s.rename(columns={"row_idx": "ft2_idx"})
+
+    # Use merge_asof to find the first FT2 after FT1 (within same game + team)
+    ft1_ft2 = pd.merge_asof(
+        ft1s.sort_values("ft1_idx"),
+        ft2s.sort_values("ft2_idx"),
+        by=["gameid", "team"],
+        left_on="ft1_idx",
+        right_on="ft2_idx",
+        direction="forward"
+    )
+
+    # Drop rows in between each FT1 and its matching FT2
+    to_drop = (
+        ft1_ft2[ft1_ft2["ft2_idx"].notna()]
+        .apply(lambda row: list(range(int(row["ft1_idx"]) + 1, int(row["ft2_idx"]))), axis=1)
+        .explode()
+        .dropna()
+        .astype(int)
+        .tolist()
+    )
+
+    # Also drop the original FT2
+    to_drop += ft1_ft2["ft2_idx"].dropna().astype(int).tolist()
+
+    # Prepare FT2s to be reinserted right after FT1s
+    new_ft2_rows = df.loc[ft1_ft2["ft2_idx"].dropna().astype(int)].copy().reset_index(drop=True)
+    new_ft2_rows["EventIndex"] = ft1_ft2["ft1_EventIndex"].reset_index(drop=True) + 0.01
+
+    # Drop the bad rows and insert the fixed FT2s
+    df = df.drop(index=to_drop).reset_index(drop=True)
+    df = pd.concat([df, new_ft2_rows], ignore_index=True)
+    df = df.sort_values(by=["gameid", "EventIndex"]).reset_index(drop=True)
+
+    return df.drop(columns="row_idx")
+
+def legacy_set_event_type(df):
+    new_df = df.copy()
+    def get_event_type(row):
+        if row["type"] in eventType and isinstance(eventType[row["type"]], str):
+            return eventType[row["type"]]
+        elif row["type"] in eventType and row["subtype"] in eventType[row["type"]]:
+            return eventType[row["type"]][row["subtype"]]
+        else:
+            print(row["type"], row["subtype"])
+    new_df = new_df[~((new_df["type"].isna()) & (new_df["subtype"].isna()))]
+    new_df["eventType"] = new_df.apply(get_event_type, axis=1)
+    return new_df
+
+def legacy_set_game_possession_team(game_id, game_df):
+    possession_col = pd.Series(pd.NA, index=game_df.index, dtype="object")
+
+    last_team = None
+    possession_change = (game_df["possessionChange"] == True) & (game_df["type"] != "Jump Ball")
+
+    for i in game_df.index:
+        event = game_df.at[i, "eventType"]
+        if event == "Home Won Jump Ball":
+            last_team = game_df.at[i, "homeTeam"]
+        elif event == "Away Won Jump Ball":
+            last_team = game_df.at[i, "awayTeam"]
+        elif possession_change[i] and last_team:
+            last_team = (
+                game_df.at[i, "awayTeam"]
+                if last_team == game_df.at[i, "homeTeam"]
+                else game_df.at[i, "homeTeam"]
+            )
+        if last_team:
+            possession_col.at[i] = last_team
+    return possession_col
+
+def legacy_set_possession_team(df):
+    new_df = df.copy()
+    new_df["possessionTeam"] = pd.NA
+
+    grouped = list(new_df.groupby("gameid"))
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        futures = {executor.submit(legacy_set_game_possession_team, gid, gdf): gid for gid, gdf in grouped}
+        for future in as_completed(futures):
+            possession_result = future.result()
+            new_df.loc[possession_result.index, "possessionTeam"] = possession_result
+            
+    return new_df
+
+legacy_steps = {
+    "get_home_away": legacy_get_home_away,
+    "set_ft_result": legacy_set_ft_result,
+    "set_jumpball_subtype": legacy_set_jumpball_subtype,
+    "add_inbounds": legacy_add_inbounds,
+    "set_inbound_team": legacy_set_inbound_team,
+    "set_shot_type": legacy_set_shot_type,
+    "fix_free_throw_sequences": legacy_fix_free_throw_sequences,
+    "set_event_type": legacy_set_event_type,
+    "set_possession_team": legacy_set_possession_team,
+}
+
+def run_legacy(df):
+    with mock.patch.multiple(pbp_processing, **legacy_steps):
+        return pbp_processing.transform_season_pbp(df)
+
+def compare_season(season):
+    df = storage.read_season(season, stage="clean", categorical=False)
+    new = pbp_processing.transform_season_pbp(df.copy()).to_csv()
+    old = run_legacy(df.copy()).to_csv()
+    if new == old:
+        return season, True, None
+
+    new_lines, old_lines = new.splitlines(), old.splitlines()
+    for line, (a, b) in enumerate(zip(new_lines, old_lines)):
+        if a != b:
+            return season, False, (line, a, b)
+    return season, False, (min(len(new_lines), len(old_lines)), len(new_lines), len(old_lines))
+
+if __name__ == "__main__":
+    seasons = [int(s) for s in sys.argv[1:]] or list(range(1997, 2024))
+    failed = False
+    for season in seasons:
+        season, same, diff = compare_season(season)
+        print(season, "identical" if same else f"DIFFERS at {diff}")
+        failed = failed or not same
+    sys.exit(1 if failed else 0)
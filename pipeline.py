@@ -0,0 +1,121 @@
+import json
+import os
+import pickle
+import sys
+import time
+
+import kagglehub
+import pandas as pd
+
+import instrument
+import pbp_processing
+import scheduler
+import stage_cache
+import storage
+import team_probabilities
+import year_processing
+
+# Fused mode runs raw CSV -> clean -> pbp -> Markov counts for a season inside one worker and
+# only returns the per-team counts. The staged mode runs each script's parallel_main in turn and
+# leaves the clean and pbp files on disk for debugging. The streamed mode writes the pbp files
+# while holding only a few games per season in memory (PBP_MAX_MEMORY).
+
+fused_modules = ("pipeline", "year_processing", "pbp_processing", "team_probabilities", "storage")
+
+def fused_cache_path(season):
+    return os.path.join(stage_cache.cache_dir, f"fused_{season}.pkl")
+
+def process_season_fused(path, season):
+    df = pd.read_csv(path + f"/pbp{season}.csv")
+    df = storage.handoff(year_processing.clean_season(df), categorical=False)
+    df = storage.handoff(pbp_processing.transform_season_pbp(df), columns=team_probabilities.markov_columns)
+    return team_probabilities.season_markovs_from_frame(season, df)
+
+def fused_main(path, seasons=range(2015, 2023), max_workers=None, force=False):
+    seasons = list(seasons)
+    code = stage_cache.code_version(*fused_modules)
+    input_path = lambda season: path + f"/pbp{season}.csv"
+    stale, manifest = stage_cache.stale_seasons("fused", seasons, input_path, fused_cache_path, code, force)
+
+    results = {}
+    for season in seasons:
+        if season not in stale:
+            with open(fused_cache_path(season), "rb") as f:
+                results[season] = pickle.load(f)
+
+    def on_result(season, result):
+        results[season] = result
+        os.makedirs(stage_cache.cache_dir, exist_ok=True)
+        with open(fused_cache_path(season), "wb") as out:
+            pickle.dump(result, out)
+        stage_cache.record(manifest, season, input_path(season), fused_cache_path(season), code)
+        stage_cache.save_manifest("fused", manifest)
+
+    tasks = [scheduler.task(season, process_season_fused, path, season, size=scheduler.file_size(input_path(season)))
+             for season in stale]
+    _, timings = scheduler.run_tasks(tasks, max_workers, desc="Seasons", on_result=on_result,
+                                     timings_path="logs/pipeline_timings.csv")
+    scheduler.report_timings(timings, desc="Seasons")
+    missing = [season for season in stale if season not in results]
+    if missing:
+        raise RuntimeError(f"Fused pipeline failed for seasons {missing}")
+    return merge_seasons(results, seasons)
+
+def merge_seasons(results, seasons):
+    # results maps season -> (season, team_markovs, team_meta) as returned by season_markovs_from_frame
+    markovs = {}
+    meta = {}
+    for season in seasons:
+        _, team_markovs, team_meta = results[season]
+        markovs[season] = team_markovs
+        team_probabilities.add_season_meta(meta, team_meta)
+    return markovs, meta
+
+def write_team_files(markovs, meta, directory="."):
+    team_matrices = team_probabilities.average_markov_matrices(markovs)
+    team_metadata = team_probabilities.convert_meta_to_probs(meta)
+
+    with open(os.path.join(directory, "team_matrices.json"), "w") as f:
+        json.dump(team_matrices, f, indent=2)
+
+    with open(os.path.join(directory, "team_metadata.json"), "w") as f:
+        json.dump(team_metadata, f, indent=2)
+
+    team_probabilities.write_team_model(os.path.join(directory, "team_model.npz"), team_matrices, team_metadata)
+    return team_matrices, team_metadata
+
+def process_season_streamed(path, season, max_memory=None):
+    # Raw CSV -> clean -> pbp a few games at a time; only the pbp file is written
+    clean = (storage.handoff(batch, categorical=False) for batch in year_processing.stream_season(path, season, max_memory))
+    return storage.write_season_stream(pbp_processing.transform_games_stream(clean), season)
+
+def streamed_main(path, seasons=range(1997, 2024), max_workers=None, max_memory=None):
+    tasks = [scheduler.task(season, process_season_streamed, path, season, max_memory,
+                            size=scheduler.file_size(path + f"/pbp{season}.csv"))
+             for season in seasons]
+    _, timings = scheduler.run_tasks(tasks, max_workers, desc="Seasons", timings_path="logs/pipeline_timings.csv")
+    scheduler.report_timings(timings, desc="Seasons")
+    return team_probabilities.parallel_main(max_workers=max_workers)
+
+def staged_main(force=False, max_workers=None):
+    year_processing.parallel_main(force, max_workers)
+    pbp_processing.parallel_main(force, max_workers)
+    return team_probabilities.parallel_main(force, max_workers)
+
+if __name__ == "__main__":
+    start_time = time.time()
+    if instrument.enabled:
+        instrument.reset()
+    if "--staged" in sys.argv:
+        markovs, meta = staged_main("--force" in sys.argv)
+    elif "--streamed" in sys.argv:
+        path = kagglehub.dataset_download("szymonjwiak/nba-play-by-play-data-1997-2023")
+        markovs, meta = streamed_main(path)
+    else:
+        path = kagglehub.dataset_download("szymonjwiak/nba-play-by-play-data-1997-2023")
+        markovs, meta = fused_main(path, force="--force" in sys.argv)
+
+    write_team_files(markovs, meta)
+    print("Done in", round(time.time() - start_time, 2), "seconds.")
+    if instrument.enabled:
+        instrument.report()
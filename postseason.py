@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+
+import simulation
+
+# Postseason for a batch of simulated seasons at once. Every replicate is seeded, runs the play-in
+# and the bracket with array operations; nothing loops over replicates. Games use the home-court
+# matchup win probabilities from the team matrices (simulation.matchup_win_probs) and a series is
+# decided by one draw against its exact best-of-seven win probability.
+
+rounds = ["play_in", "playoffs", "second_round", "conference_finals", "finals", "champion"]
+series_home_pattern = "HHAAHAH"   # 2-2-1-1-1 from the side with home court
+
+def conference_indices(teams):
+    return [np.array([teams.index(team) for team in conference if team in teams])
+            for conference in [simulation.eastern_conference, simulation.western_conference]]
+
+def tiebreak_keys(wins, head_to_head, conferences):
+    # Net record against the other teams tied on wins in the conference, then net conference record.
+    # head_to_head[r, i, j] is how many times i beat j in replicate r.
+    n_teams = wins.shape[1]
+    same_conference = np.zeros((n_teams, n_teams), dtype=bool)
+    for cols in conferences:
+        same_conference[np.ix_(cols, cols)] = True
+    np.fill_diagonal(same_conference, False)
+    net = head_to_head.astype(np.int16) - head_to_head.transpose(0, 2, 1).astype(np.int16)
+    tied = (wins[:, :, None] == wins[:, None, :]) & same_conference
+    return (net * tied).sum(axis=2), (net * same_conference).sum(axis=2)
+
+def seed_conferences(wins, teams, rng, head_to_head=None, batch_size=10000):
+    # replicates x conference (East, West) x seed -> team index. Ties on wins go to head-to-head among
+    # the tied teams, then conference record (both only with head_to_head), then a random draw.
+    # Divisions are not modelled, so division tiebreakers are skipped.
+    wins = np.atleast_2d(wins)
+    conferences = conference_indices(teams)
+    key = wins * 1e6 + rng.random(wins.shape)
+    if head_to_head is not None:
+        for start in range(0, len(wins), batch_size):
+            stop = start + batch_size
+            tied_net, conference_net = tiebreak_keys(wins[start:stop], head_to_head[start:stop], conferences)
+            key[start:stop] += (tied_net + 500) * 1e3 + (conference_net + 500)
+    size = max(len(cols) for cols in conferences)
+    seeds = np.full((len(wins), len(conferences), size), -1, dtype=np.int64)
+    for c, cols in enumerate(conferences):
+        seeds[:, c, :len(cols)] = cols[np.argsort(-key[:, cols], axis=1)]
+    return seeds
+
+def series_win_probs(win_probs, wins_needed=4, pattern=series_home_pattern):
+    # probs[h, a] = P(h wins a best-of-seven holding home court), exact over every game sequence
+    home_win = win_probs
+    road_win = 1 - win_probs.T
+    # state[i, j]: P(series is at i wins for h and j for a after this many games); finished series drop out
+    state = np.zeros((wins_needed + 1, wins_needed + 1) + win_probs.shape)
+    state[0, 0] = 1
+    done = np.zeros(win_probs.shape)
+    for game in range(2 * wins_needed - 1):
+        p = home_win if pattern[game] == "H" else road_win
+        nxt = np.zeros_like(state)
+        for i in range(wins_needed):
+            for j in range(wins_needed):
+                nxt[i + 1, j] += state[i, j] * p
+                nxt[i, j + 1] += state[i, j] * (1 - p)
+        done += nxt[wins_needed, :wins_needed].sum(axis=0)
+        nxt[wins_needed] = 0
+        nxt[:, wins_needed] = 0
+        state = nxt
+    return done
+
+def play_game(home, away, win_probs, rng):
+    home_won = rng.random(len(home)) < win_probs[home, away]
+    return np.where(home_won, home, away), np.where(home_won, away, home)
+
+def play_series(high, low, series_probs, rng):
+    # high has home court
+    high_won = rng.random(len(high)) < series_probs[high, low]
+    return np.where(high_won, high, low)
+
+def simulate_postseason(wins, teams, win_probs, rng=None, head_to_head=None):
+    # wins: replicates x teams season wins. Returns the seeds, each replicate's champion and a
+    # teams x rounds frame of the probability of reaching each round
+    rng = np.random.default_rng(rng)
+    wins = np.atleast_2d(wins)
+    n_replicates, n_teams = wins.shape
+    series_probs = series_win_probs(win_probs)
+    seeds = seed_conferences(wins, teams, rng, head_to_head)
+    reached = {name: np.zeros((n_replicates, n_teams), dtype=bool) for name in rounds}
+    rows = np.arange(n_replicates)
+
+    def mark(name, team):
+        reached[name][rows, team] = True
+
+    champions = []
+    for c in range(seeds.shape[1]):
+        seed = seeds[:, c]
+        # Play-in: 7 v 8 for the 7 seed, 9 v 10 for a shot at the 8 seed against the 7 v 8 loser
+        for s in range(6, 10):
+            mark("play_in", seed[:, s])
+        seventh, loser_78 = play_game(seed[:, 6], seed[:, 7], win_probs, rng)
+        winner_910, _ = play_game(seed[:, 8], seed[:, 9], win_probs, rng)
+        eighth, _ = play_game(loser_78, winner_910, win_probs, rng)
+        bracket = np.column_stack([seed[:, :6], seventh, eighth])
+        for s in range(8):
+            mark("playoffs", bracket[:, s])
+
+        # Bracket order 1, 8, 4, 5, 3, 6, 2, 7: neighbours meet, and the better seed has home court
+        field = [(bracket[:, s], np.full(n_replicates, s)) for s in [0, 7, 3, 4, 2, 5, 1, 6]]
+        for name in ["second_round", "conference_finals", "finals"]:
+            next_field = []
+            for (a, a_seed), (b, b_seed) in zip(field[::2], field[1::2]):
+                a_home = a_seed < b_seed
+                winner = play_series(np.where(a_home, a, b), np.where(a_home, b, a), series_probs, rng)
+                mark(name, winner)
+                next_field.append((winner, np.where(winner == a, a_seed, b_seed)))
+            field = next_field
+        champions.append(field[0][0])
+
+    # Finals: home court to the better record, ties broken by a random draw
+    east, west = champions
+    key = wins + rng.random(wins.shape)
+    east_home = key[rows, east] > key[rows, west]
+    home = np.where(east_home, east, west)
+    away = np.where(east_home, west, east)
+    champion = play_series(home, away, series_probs, rng)
+    mark("champion", champion)
+
+    odds = pd.DataFrame({name: reached[name].mean(axis=0) for name in rounds}, index=teams)
+    return {"seeds": seeds, "champion": champion, "odds": odds}
+
+def seed_probabilities(seeds, teams):
+    # P(team finishes at each conference seed) from seed_conferences output
+    size = seeds.shape[2]
+    probs = pd.DataFrame(0.0, index=teams, columns=range(1, size + 1))
+    for c in range(seeds.shape[1]):
+        for s in range(size):
+            counts = np.bincount(seeds[:, c, s][seeds[:, c, s] >= 0], minlength=len(teams)) / len(seeds)
+            probs[s + 1] += counts
+    return probs
@@ -0,0 +1,135 @@
+import argparse
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+import postseason
+import simulation
+import storage
+
+# Rest-of-season projections. Games up to the cutoff keep their real results from the pbp files;
+# every remaining game is drawn from the matchup win probabilities of the compiled team parameters,
+# which give game results the same distribution as simulate_games at a fraction of the cost.
+
+def played_results(season, cutoff, directory=None):
+    # Final score of every game with gameid <= cutoff in the pbp stage; undecided games are left out
+    df = storage.read_season(season, columns=["gameid", "homeTeam", "awayTeam", "h_pts", "a_pts"],
+                             directory=directory, categorical=False, filters=[("gameid", "<=", cutoff)])
+    games = df.groupby("gameid", sort=True).agg(
+        homeTeam=("homeTeam", "first"), awayTeam=("awayTeam", "first"),
+        home_points=("h_pts", "max"), away_points=("a_pts", "max"),
+    ).reset_index()
+    return games[games["home_points"] != games["away_points"]].reset_index(drop=True)
+
+def cutoff_gameid(schedule, cutoff):
+    # A game id is used as is; a date needs a schedule with a date column
+    if isinstance(cutoff, (int, np.integer)):
+        return int(cutoff)
+    if "date" not in schedule:
+        raise ValueError("a date cutoff needs a schedule with a 'date' column")
+    played = schedule.loc[pd.to_datetime(schedule["date"]) <= pd.Timestamp(cutoff), "gameid"]
+    return int(played.max()) if len(played) else -1
+
+def team_params(teams, model_path="team_model.npz"):
+    if model_path is not None and os.path.exists(model_path):
+        return simulation.load_team_model(model_path, teams)
+    meta, probs = simulation.load_team_inputs(model_path=None)
+    return simulation.compile_team_params(probs, meta, teams)
+
+def sample_remaining_wins(win_probs, home, away, n_teams, n_replicates, rng, batch_size=5000):
+    # replicates x teams wins and replicates x teams x teams head-to-head wins over the remaining
+    # games, drawn in batches of replicates
+    home_games = np.zeros((len(home), n_teams))
+    home_games[np.arange(len(home)), home] = 1
+    away_games = np.zeros((len(away), n_teams))
+    away_games[np.arange(len(away)), away] = 1
+    # Games grouped by (home, away) pair so head-to-head counts are one reduceat per batch
+    pair = home * n_teams + away
+    order = np.argsort(pair, kind="stable")
+    pairs, starts, games = np.unique(pair[order], return_index=True, return_counts=True)
+    reverse = (pairs % n_teams) * n_teams + pairs // n_teams
+
+    p = win_probs[home, away]
+    wins = np.empty((n_replicates, n_teams), dtype=np.int64)
+    head_to_head = np.zeros((n_replicates, n_teams * n_teams), dtype=np.uint8)
+    for start in range(0, n_replicates, batch_size):
+        stop = min(start + batch_size, n_replicates)
+        home_won = rng.random((stop - start, len(home))) < p
+        wins[start:stop] = home_won @ home_games + (~home_won) @ away_games
+        if len(pairs):
+            home_pair_wins = np.add.reduceat(home_won[:, order], starts, axis=1, dtype=np.int64)
+            head_to_head[start:stop, pairs] += home_pair_wins.astype(np.uint8)
+            head_to_head[start:stop, reverse] += (games - home_pair_wins).astype(np.uint8)
+    return wins, head_to_head.reshape(n_replicates, n_teams, n_teams)
+
+def project_season(cutoff, season=2023, n_replicates=10000, seed=None, params=None, schedule=None, results=None,
+                   model_path="team_model.npz", win_probs=None, max_games=82):
+    # Final-win distributions, seed probabilities and the odds of reaching each postseason round given
+    # every result up to cutoff (a game id, or a date if schedule has a date column). params and
+    # win_probs can be passed in to reuse them.
+    teams = list(simulation.actual_wins_2223)
+    if schedule is None:
+        schedule = simulation.load_schedule(season)
+    cutoff = cutoff_gameid(schedule, cutoff)
+    if results is None:
+        results = played_results(season, cutoff)
+    if win_probs is None:
+        win_probs = simulation.matchup_win_probs(params if params is not None else team_params(teams, model_path))
+
+    season_schedule = simulation.compile_schedule(schedule, teams, max_games)
+    home, away = season_schedule["home"], season_schedule["away"]
+    gameids = schedule["gameid"].to_numpy()[season_schedule["game_index"]]
+    final = results[results["gameid"] <= cutoff].set_index("gameid")
+    played = np.isin(gameids, final.index)
+    home_won = (final["home_points"] > final["away_points"]).reindex(gameids[played]).to_numpy(dtype=bool)
+    current_wins, current_losses = simulation.season_records(home[played], away[played], home_won, len(teams))
+    current_head_to_head = np.zeros((len(teams), len(teams)), dtype=np.uint8)
+    np.add.at(current_head_to_head, (np.where(home_won, home[played], away[played]),
+                                     np.where(home_won, away[played], home[played])), 1)
+
+    rng = np.random.default_rng(seed)
+    remaining = ~played
+    wins, head_to_head = sample_remaining_wins(win_probs, home[remaining], away[remaining], len(teams), n_replicates, rng)
+    wins += current_wins
+    head_to_head += current_head_to_head
+
+    # Playoff odds come from postseason, after the play-in
+    summary = simulation.summarize_replicates(wins, teams, rng, playoff_odds=False)
+    summary.insert(0, "losses", current_losses)
+    summary.insert(0, "wins", current_wins)
+    playoffs = postseason.simulate_postseason(wins, teams, win_probs, rng, head_to_head)
+    return {
+        "teams": teams,
+        "cutoff": cutoff,
+        "played": int(played.sum()),
+        "remaining": int(remaining.sum()),
+        "wins": wins,
+        "summary": summary,
+        "postseason": playoffs["odds"],
+        "seeds": postseason.seed_probabilities(playoffs["seeds"], teams),
+    }
+
+def parse_cutoff(text):
+    return int(text) if text.isdigit() else pd.Timestamp(text)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Project the rest of a season from the results so far.")
+    parser.add_argument("--cutoff", type=parse_cutoff, required=True, help="last played game id (or date, with --schedule)")
+    parser.add_argument("--season", type=int, default=2023)
+    parser.add_argument("--schedule", help="CSV of gameid, homeTeam, awayTeam[, date] for the full season (default: pbp stage)")
+    parser.add_argument("--replicates", type=int, default=10000)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--output", default="projection.csv")
+    args = parser.parse_args()
+
+    start_time = time.time()
+    schedule = pd.read_csv(args.schedule) if args.schedule else None
+    projection = project_season(args.cutoff, args.season, args.replicates, args.seed, schedule=schedule)
+    table = projection["summary"].join(projection["postseason"]).join(projection["seeds"].add_prefix("seed_"))
+    table.to_csv(args.output)
+    print(f"{projection['played']} games played, {projection['remaining']} simulated {args.replicates} times")
+    print(projection["summary"].join(projection["postseason"]).sort_values("champion", ascending=False)
+          .to_string(float_format=lambda x: f"{x:.2f}"))
+    print("Done in", round(time.time() - start_time, 2), "seconds.")
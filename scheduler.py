@@ -0,0 +1,70 @@
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+from tqdm import tqdm
+
+# One flat process pool per run. Work is split into tasks (a season, a team's Markov build for a
+# season, ...) that are submitted largest first so the long ones don't start last and straggle.
+
+def available_cpus():
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+def task(key, fn, *args, size=1):
+    return {"key": key, "fn": fn, "args": args, "size": size}
+
+def file_size(path):
+    return os.path.getsize(path) if os.path.exists(path) else 0
+
+def _run_task(fn, args):
+    start = time.time()
+    result = fn(*args)
+    return result, start, time.time() - start, os.getpid()
+
+def run_tasks(tasks, max_workers=None, desc="Tasks", on_result=None, timings_path=None):
+    # Returns {key: result} and a frame of per-task timings; on_result(key, result) runs in the parent
+    # as each task finishes. A failed task is reported and left out of the results.
+    tasks = sorted(tasks, key=lambda t: t["size"], reverse=True)
+    max_workers = max(1, min(max_workers or available_cpus(), len(tasks) or 1))
+
+    results = {}
+    timings = []
+    run_start = time.time()
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(_run_task, t["fn"], t["args"]): t for t in tasks}
+        for f in tqdm(as_completed(futures), total=len(futures), desc=desc):
+            t = futures[f]
+            try:
+                result, start, seconds, pid = f.result()
+            except Exception as e:
+                print(f"{desc} {t['key']} failed: {e!r}")
+                timings.append({"key": t["key"], "size": t["size"], "start": None, "seconds": None, "worker": None})
+                continue
+            results[t["key"]] = result
+            timings.append({"key": t["key"], "size": t["size"], "start": start - run_start, "seconds": seconds, "worker": pid})
+            if on_result is not None:
+                on_result(t["key"], result)
+
+    timings = pd.DataFrame(timings, columns=["key", "size", "start", "seconds", "worker"])
+    timings.attrs["wall_seconds"] = time.time() - run_start
+    timings.attrs["workers"] = max_workers
+    if timings_path is not None:
+        os.makedirs(os.path.dirname(timings_path) or ".", exist_ok=True)
+        timings.to_csv(timings_path, index=False)
+    return results, timings
+
+def report_timings(timings, desc="Tasks", top=5):
+    if timings.empty:
+        return
+    wall = timings.attrs.get("wall_seconds", float("nan"))
+    workers = timings.attrs.get("workers", 1)
+    busy = timings["seconds"].sum()
+    print(f"{desc}: {len(timings)} tasks on {workers} workers in {wall:.1f}s "
+          f"({busy:.1f}s of task time, {busy / (wall * workers):.0%} pool utilisation)")
+    print(timings.sort_values("seconds", ascending=False).head(top).to_string(index=False))
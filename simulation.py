@@ -1,9 +1,13 @@
 import json
+import os
 import random
 from collections import defaultdict
 import pandas as pd
 import numpy as np
 import copy
+from concurrent.futures import ProcessPoolExecutor
+import storage
+import instrument
 import matplotlib.pyplot as plt
 from matplotlib.patches import Patch
 
@@ -16,6 +20,17 @@ actual_wins_2223 = {
     "SAC": 48, "SAS": 22, "TOR": 41, "UTA": 37, "WAS": 35
 }
 
+eastern_conference = ["ATL", "BOS", "BKN", "CHA", "CHI", "CLE", "DET", "IND", "MIA", "MIL",
+                      "NYK", "ORL", "PHI", "TOR", "WAS"]
+western_conference = [team for team in actual_wins_2223 if team not in eastern_conference]
+
+locations = ["Home", "Away"]
+start_types = ["Defensive Rebound", "Inbound", "Steal"]
+outcome_types = ["2PT Blocked", "2PT Made", "2PT Missed", "3PT Made", "3PT Missed", "Free Throw", "Turnover"]
+outcome_points = np.array([0, 2, 0, 3, 0, 1, 0])
+# Outcomes from fewest to most points; sampling from fixed uniforms inverts the CDF in this order
+# so a larger draw never means fewer points, which keeps common and antithetic draws tightly coupled
+points_order = np.argsort(outcome_points, kind="stable")
 
 
 def flip_nested_dict(d):
@@ -65,97 +80,591 @@ def simulate_game(team1, team2, home_team, team1_matrix, team2_matrix, team1_met
     team2_score = monte_carlo_sim(team2_loc, team2_matrix, team2_meta, poss)
     return team1 if team1_score > team2_score else team2
 
+def compile_team_params(probs, meta, teams=None):
+    # Dense (team, location, start, outcome) arrays so a whole season can be sampled at once
+    if teams is None:
+        teams = sorted(probs)
+    start_probs = np.zeros((len(teams), len(locations), len(start_types)))
+    transitions = np.zeros((len(teams), len(locations), len(start_types), len(outcome_types)))
+    possessions = np.zeros((len(teams), len(locations)))
+
+    for t, team in enumerate(teams):
+        for l, loc in enumerate(locations):
+            start_type_probs = meta[team][loc]["start_type_probs"]
+            possessions[t, l] = meta[team][loc]["avg_possessions_per_game"]
+            for s, start in enumerate(start_types):
+                start_probs[t, l, s] = start_type_probs.get(start, 0)
+                for o, outcome in enumerate(outcome_types):
+                    transitions[t, l, s, o] = probs[team][loc].get(outcome, {}).get(start, 0)
+
+    return build_team_params(teams, start_probs, transitions, possessions)
+
+def build_team_params(teams, start_probs, transitions, possessions):
+    start_cdf = np.cumsum(start_probs, axis=-1)
+    start_cdf /= np.where(start_cdf[..., -1:] > 0, start_cdf[..., -1:], 1)
+    trans_cdf = np.cumsum(transitions, axis=-1)
+    trans_cdf /= np.where(trans_cdf[..., -1:] > 0, trans_cdf[..., -1:], 1)
+    points_cdf = np.cumsum(transitions[..., points_order], axis=-1)
+    empty = points_cdf[..., -1] == 0
+    points_cdf /= np.where(points_cdf[..., -1:] > 0, points_cdf[..., -1:], 1)
+    # An all-zero row falls through to the last outcome in trans_cdf; keep that outcome here too
+    points_cdf[empty] = np.cumsum(points_order == len(outcome_types) - 1)
+    return {
+        "teams": list(teams),
+        "start_probs": start_probs,
+        "transitions": transitions,
+        "possessions": possessions,
+        "start_cdf": start_cdf,
+        "trans_cdf": trans_cdf,
+        "points_cdf": points_cdf,
+    }
+
+def game_possessions(params, home_idx, away_idx):
+    poss = (0.75 * params["possessions"][home_idx, 0] +
+            0.25 * params["possessions"][away_idx, 1])
+    return np.maximum(np.trunc(poss), 0).astype(np.int64)
+
+def sample_points(params, team_idx, loc, n_poss, rng, uniforms=None):
+    # uniforms, if given, are the (start, outcome) draws for every game and possession slot
+    width = int(n_poss.max()) if len(n_poss) else 0
+    n_starts, n_outcomes = len(start_types), len(outcome_types)
+
+    start_cdf = params["start_cdf"][team_idx, loc]
+    u = rng.random((len(team_idx), width)) if uniforms is None else uniforms[0][:, :width]
+    starts = np.minimum((u[:, :, None] >= start_cdf[:, None, :]).sum(axis=-1), n_starts - 1)
+
+    if uniforms is None:
+        trans_cdf = params["trans_cdf"][team_idx[:, None], loc, starts]
+        u = rng.random((len(team_idx), width))
+        outcomes = np.minimum((u[:, :, None] >= trans_cdf).sum(axis=-1), n_outcomes - 1)
+    else:
+        points_cdf = params["points_cdf"][team_idx[:, None], loc, starts]
+        u = uniforms[1][:, :width]
+        outcomes = points_order[np.minimum((u[:, :, None] >= points_cdf).sum(axis=-1), n_outcomes - 1)]
+
+    points = np.where(np.arange(width) < n_poss[:, None], outcome_points[outcomes], 0)
+    return points.sum(axis=1)
+
+def simulate_games(params, home_idx, away_idx, rng=None, uniforms=None):
+    # With uniforms from common_uniforms every game and possession slot uses a fixed draw, so runs
+    # with different parameters see the same randomness (common random numbers)
+    rng = np.random.default_rng(rng)
+    home_idx = np.asarray(home_idx)
+    away_idx = np.asarray(away_idx)
+    n_poss = game_possessions(params, home_idx, away_idx)
+    if uniforms is not None and len(n_poss) and n_poss.max() > uniforms.shape[-1]:
+        raise ValueError(f"{n_poss.max()} possessions in a game but uniforms only cover {uniforms.shape[-1]}")
+    home_points = sample_points(params, home_idx, 0, n_poss, rng, None if uniforms is None else uniforms[0:2])
+    away_points = sample_points(params, away_idx, 1, n_poss, rng, None if uniforms is None else uniforms[2:4])
+    return home_points, away_points
+
+max_game_possessions = 200
+
+def common_uniforms(seed, n_games, width=max_game_possessions):
+    # (home start, home outcome, away start, away outcome) x game x possession slot. The width is
+    # fixed rather than taken from the parameters so a slot gets the same draw in every configuration.
+    return np.random.default_rng(seed).random((4, n_games, width))
+
+def iteration_seed(seed, i):
+    # Child i of seed without advancing it, so iteration i sees the same stream in every run
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    return np.random.SeedSequence(seed.entropy, spawn_key=tuple(seed.spawn_key) + (i,))
+
+def compile_schedule(schedule, teams, max_games=82):
+    team_index = {team: i for i, team in enumerate(teams)}
+    home_idx = schedule["homeTeam"].astype(object).map(team_index)
+    away_idx = schedule["awayTeam"].astype(object).map(team_index)
+    if home_idx.isna().any() or away_idx.isna().any():
+        raise KeyError("schedule contains teams without parameters")
+    home_idx = home_idx.to_numpy(dtype=np.int64)
+    away_idx = away_idx.to_numpy(dtype=np.int64)
+
+    # A game is skipped once either team already has max_games decisions. Every
+    # counted game produces exactly one decision, so the mask does not depend on
+    # the simulated results and can be fixed for the whole run.
+    counted = np.zeros(len(home_idx), dtype=bool)
+    games_played = np.zeros(len(teams), dtype=np.int64)
+    for g, (h, a) in enumerate(zip(home_idx, away_idx)):
+        if games_played[h] < max_games and games_played[a] < max_games:
+            counted[g] = True
+            games_played[h] += 1
+            games_played[a] += 1
+
+    return {
+        "teams": list(teams),
+        "home": home_idx[counted],
+        "away": away_idx[counted],
+        "game_index": np.flatnonzero(counted),
+    }
+
+def season_records(home_idx, away_idx, home_won, n_teams):
+    winners = np.where(home_won, home_idx, away_idx)
+    losers = np.where(home_won, away_idx, home_idx)
+    wins = np.bincount(winners, minlength=n_teams)
+    losses = np.bincount(losers, minlength=n_teams)
+    return wins, losses
+
+def simulate_season(params, season_schedule, rng=None, simulate_games=simulate_games, uniforms=None):
+    if uniforms is None:
+        home_points, away_points = simulate_games(params, season_schedule["home"], season_schedule["away"], rng)
+    else:
+        home_points, away_points = simulate_games(params, season_schedule["home"], season_schedule["away"], rng,
+                                                  uniforms=uniforms)
+    return season_records(season_schedule["home"], season_schedule["away"],
+                          home_points > away_points, len(season_schedule["teams"]))
+
+def possession_point_pmf(params):
+    # P(points scored on one possession) over 0..3, mixing start types into the transition rows.
+    # An all-zero row puts its mass on the last start or outcome (Turnover), as the sampler does.
+    start = np.diff(params["start_cdf"], axis=-1, prepend=0)
+    start[..., -1] += np.maximum(1 - start.sum(axis=-1), 0)
+    trans = np.diff(params["trans_cdf"], axis=-1, prepend=0)
+    trans[..., -1] += np.maximum(1 - trans.sum(axis=-1), 0)
+    outcome = np.einsum("tls,tlso->tlo", start, trans)
+    pmf = np.zeros(outcome.shape[:-1] + (outcome_points.max() + 1,))
+    for o, points in enumerate(outcome_points):
+        pmf[..., points] += outcome[..., o]
+    return pmf
+
+def score_pmf(point_pmf, n_poss, length):
+    # Sum of n i.i.d. possessions: n-fold convolution done as a power in Fourier space
+    spectrum = np.fft.rfft(point_pmf, length, axis=-1) ** n_poss[..., None]
+    return np.clip(np.fft.irfft(spectrum, length, axis=-1), 0, None)
+
+def matchup_win_probs(params, home_idx=None, away_idx=None):
+    # P(home outscores away) for every (home, away) pair; ties go to the away side as in simulate_game
+    n_teams = len(params["teams"])
+    home_idx = np.arange(n_teams) if home_idx is None else np.asarray(home_idx)
+    away_idx = np.arange(n_teams) if away_idx is None else np.asarray(away_idx)
+    if len(home_idx) == 0 or len(away_idx) == 0:
+        return np.zeros((len(home_idx), len(away_idx)))
+
+    point_pmf = possession_point_pmf(params)
+    n_poss = game_possessions(params, home_idx[:, None], away_idx[None, :])
+    length = 1 << int(outcome_points.max() * n_poss.max()).bit_length()
+
+    home_pmf = score_pmf(point_pmf[home_idx, 0][:, None, :], n_poss, length)
+    away_cdf = np.cumsum(score_pmf(point_pmf[away_idx, 1][None, :, :], n_poss, length), axis=-1)
+    return np.clip((home_pmf[..., 1:] * away_cdf[..., :-1]).sum(axis=-1), 0, 1)
+
+def expected_season_wins(params, season_schedule, win_probs=None):
+    if win_probs is None:
+        win_probs = matchup_win_probs(params)
+    home, away = season_schedule["home"], season_schedule["away"]
+    p = win_probs[home, away]
+    n_teams = len(season_schedule["teams"])
+    wins = np.bincount(home, p, minlength=n_teams) + np.bincount(away, 1 - p, minlength=n_teams)
+    losses = np.bincount(home, 1 - p, minlength=n_teams) + np.bincount(away, p, minlength=n_teams)
+    return wins, losses
+
+def build_matchup_table(params):
+    # win_probs[h, a] is P(h beats a with h at home), so rows cover the Home side and
+    # columns the Away side of every team: the full team x team x location table
+    return {
+        "win_probs": matchup_win_probs(params),
+        "stale": np.zeros(len(params["teams"]), dtype=bool),
+        "recomputed_pairs": 0,
+    }
+
+def invalidate_matchups(table, team_idx):
+    table["stale"][np.asarray(team_idx, dtype=np.int64)] = True
+
+def refresh_matchup_table(table, params):
+    # Only rows and columns of teams whose parameters changed are recomputed
+    stale = np.flatnonzero(table["stale"])
+    if len(stale) == 0:
+        return table
+    everyone = np.arange(len(params["teams"]))
+    table["win_probs"][stale, :] = matchup_win_probs(params, stale, everyone)
+    table["win_probs"][:, stale] = matchup_win_probs(params, everyone, stale)
+    table["recomputed_pairs"] += 2 * len(stale) * len(everyone) - len(stale) ** 2
+    table["stale"][:] = False
+    return table
+
+def sample_season_from_table(table, season_schedule, rng=None, uniforms=None):
+    # uniforms, if given, holds one fixed draw per game
+    rng = np.random.default_rng(rng)
+    home, away = season_schedule["home"], season_schedule["away"]
+    u = rng.random(len(home)) if uniforms is None else uniforms
+    home_won = u < table["win_probs"][home, away]
+    return season_records(home, away, home_won, len(season_schedule["teams"]))
+
+def point_margin_control(params, season_schedule, home_points, away_points):
+    # Each team's season point differential minus its expectation: zero mean, and strongly
+    # correlated with wins, so it works as a control variate for simulated win totals
+    home, away = season_schedule["home"], season_schedule["away"]
+    mean_points = possession_point_pmf(params) @ np.arange(outcome_points.max() + 1)
+    n_poss = game_possessions(params, home, away)
+    surprise = (home_points - away_points) - n_poss * (mean_points[home, 0] - mean_points[away, 1])
+    n_teams = len(season_schedule["teams"])
+    return np.bincount(home, surprise, minlength=n_teams) - np.bincount(away, surprise, minlength=n_teams)
+
+def estimate_season_wins(params, season_schedule, n_replicates=100, seed=None, antithetic=True, control_variate=True):
+    # Mean season wins per team and their standard errors from n_replicates simulated seasons.
+    # antithetic: replicates come in pairs using u and 1 - u; control_variate: subtract
+    # beta * point_margin_control with beta fitted per team across replicates.
+    seed_seq = np.random.SeedSequence(seed)
+    n_games = len(season_schedule["home"])
+    n_draws = (n_replicates + 1) // 2 if antithetic else n_replicates
+    wins, controls = [], []
+    for child in seed_seq.spawn(n_draws):
+        uniforms = common_uniforms(child, n_games)
+        draws = [uniforms, 1 - uniforms] if antithetic else [uniforms]
+        pair_wins, pair_controls = [], []
+        for u in draws:
+            home_points, away_points = simulate_games(params, season_schedule["home"], season_schedule["away"], uniforms=u)
+            pair_wins.append(season_records(season_schedule["home"], season_schedule["away"],
+                                            home_points > away_points, len(season_schedule["teams"]))[0])
+            pair_controls.append(point_margin_control(params, season_schedule, home_points, away_points))
+        wins.append(np.mean(pair_wins, axis=0))
+        controls.append(np.mean(pair_controls, axis=0))
+    wins, controls = np.array(wins), np.array(controls)
+
+    if control_variate and len(wins) > 1:
+        centered = controls - controls.mean(axis=0)
+        variance = (centered ** 2).sum(axis=0)
+        beta = np.where(variance > 0, (centered * (wins - wins.mean(axis=0))).sum(axis=0) / np.where(variance > 0, variance, 1), 0)
+        wins = wins - beta * controls
+    estimate = wins.mean(axis=0)
+    stderr = wins.std(axis=0, ddof=1) / np.sqrt(len(wins)) if len(wins) > 1 else np.full(len(estimate), np.nan)
+    return {"teams": list(season_schedule["teams"]), "wins": estimate, "stderr": stderr, "replicates": len(wins) * len(draws)}
+
+# Calibration nudges scoring outcomes down and empty possessions up for teams predicted to win too
+# many games (and the reverse), one sign per outcome in outcome_types order
+calibration_signs = np.array([0 if o == "2PT Blocked" else -1 if o in ("2PT Made", "3PT Made", "Free Throw") else 1
+                              for o in outcome_types])
+
+def calibration_step(transitions, possessions, errors, learn_rate, threshold):
+    # One update of every team whose win error is over the threshold: scale its transition rows,
+    # renormalize them and adjust its possessions per game, at most max_game_possessions so common
+    # random numbers always cover every game. Returns new arrays and the teams changed.
+    over = np.abs(errors) > threshold
+    if not over.any():
+        return transitions, possessions, over
+    scale = errors[over] * learn_rate * 0.01
+    updated = transitions[over] * (1 + calibration_signs * scale[:, None])[:, None, None, :]
+    totals = updated.sum(axis=-1, keepdims=True)
+    transitions = transitions.copy()
+    transitions[over] = np.where(totals > 0, updated / np.where(totals > 0, totals, 1), updated)
+    possessions = possessions.copy()
+    possessions[over] = np.minimum(possessions[over] - (errors[over] * learn_rate)[:, None], max_game_possessions)
+    return transitions, possessions, over
+
+def calibrated_meta(meta, teams, possessions):
+    meta = copy.deepcopy(meta)
+    for t, team in enumerate(teams):
+        for l, loc in enumerate(locations):
+            meta[team][loc]["avg_possessions_per_game"] = float(possessions[t, l])
+    return meta
+
+def write_transitions(probs, teams, transitions):
+    for t, team in enumerate(teams):
+        for l, loc in enumerate(locations):
+            for o, outcome in enumerate(outcome_types):
+                for s, start in enumerate(start_types):
+                    probs[team][loc][outcome][start] = float(transitions[t, l, s, o])
+    return probs
+
+def tilt_transitions(transitions, efficiency):
+    # Scoring outcomes up and empty possessions down by exp(efficiency) per team, rows renormalized
+    weights = np.exp(np.multiply.outer(efficiency, -calibration_signs))
+    tilted = transitions * weights[:, None, None, :]
+    totals = tilted.sum(axis=-1, keepdims=True)
+    return np.where(totals > 0, tilted / np.where(totals > 0, totals, 1), tilted)
+
+def schedule_games(season_schedule):
+    # games[h, a] = number of games with h at home against a
+    n_teams = len(season_schedule["teams"])
+    games = np.zeros((n_teams, n_teams))
+    np.add.at(games, (season_schedule["home"], season_schedule["away"]), 1)
+    return games
+
+def expected_wins_jacobian(state, efficiency, win_probs, games, step=1e-4):
+    # d expected wins / d efficiency by forward differences, bumping every team at once: the bumped
+    # copies are appended as teams n..2n-1 and only their rows and columns of the table are computed
+    n = len(efficiency)
+    everyone = np.arange(n)
+    both = build_team_params(
+        state["teams"] * 2,
+        np.concatenate([state["start_probs"]] * 2),
+        np.concatenate([tilt_transitions(state["transitions"], efficiency),
+                        tilt_transitions(state["transitions"], efficiency + step)]),
+        np.concatenate([state["possessions"]] * 2),
+    )
+    d_home = games * (matchup_win_probs(both, everyone + n, everyone) - win_probs)
+    d_away = games * (matchup_win_probs(both, everyone, everyone + n) - win_probs)
+    jacobian = (d_away - d_home.T) / step
+    jacobian[everyone, everyone] = (d_home.sum(axis=1) - d_away.sum(axis=0)) / step
+    return jacobian
+
+def solve_expected_wins(schedule, actual_wins, meta, probs, max_iter=15, tol=1e-4, damping=1e-3, should_stop=None):
+    # Levenberg-Marquardt on one efficiency tilt per team so that expected wins over the schedule
+    # match actual_wins. Possessions per game are left alone: they enter as whole possession counts,
+    # so expected wins are flat in them between integers. meta and probs are not modified; the fitted
+    # model comes back as the efficiencies, compiled params and a calibrated copy of probs.
+    teams = list(actual_wins)
+    actual = np.array([actual_wins[team] for team in teams], dtype=float)
+    season_schedule = compile_schedule(schedule, teams)
+    games = schedule_games(season_schedule)
+    state = compile_team_params(probs, meta, teams)
+
+    def evaluate(efficiency):
+        params = build_team_params(teams, state["start_probs"], tilt_transitions(state["transitions"], efficiency),
+                                   state["possessions"])
+        win_probs = matchup_win_probs(params)
+        wins, _ = expected_season_wins(params, season_schedule, win_probs)
+        return win_probs, wins
+
+    efficiency = np.zeros(len(teams))
+    win_probs, wins = evaluate(efficiency)
+    rmses = [np.sqrt(np.mean(np.square(wins - actual)))]
+    best_iteration = 0
+    for i in range(1, max_iter + 1):
+        with instrument.span("simulation.solve_expected_wins.iteration", iteration=i):
+            residual = wins - actual
+            jacobian = expected_wins_jacobian(state, efficiency, win_probs, games)
+            normal = jacobian.T @ jacobian
+            gradient = jacobian.T @ residual
+            improved = False
+            while damping < 1e8 and not improved:
+                step = np.linalg.solve(normal + damping * np.diag(np.diag(normal) + 1e-12), -gradient)
+                trial_probs, trial_wins = evaluate(efficiency + step)
+                trial_rmse = np.sqrt(np.mean(np.square(trial_wins - actual)))
+                if trial_rmse < rmses[-1]:
+                    efficiency, win_probs, wins = efficiency + step, trial_probs, trial_wins
+                    damping = max(damping / 10, 1e-12)
+                    improved = True
+                else:
+                    damping *= 10
+            if not improved:
+                break
+            rmses.append(trial_rmse)
+            best_iteration = i
+            if rmses[-1] < tol or rmses[-2] - rmses[-1] < tol * rmses[-2] or (should_stop is not None and should_stop(i, rmses)):
+                break
+
+    transitions = tilt_transitions(state["transitions"], efficiency)
+    order = sorted(range(len(teams)), key=lambda t: teams[t])
+    return {
+        "teams": teams,
+        "efficiency": dict(zip(teams, efficiency.tolist())),
+        "params": build_team_params(teams, state["start_probs"], transitions, state["possessions"]),
+        "meta": copy.deepcopy(meta),
+        "probs": write_transitions(copy.deepcopy(probs), teams, transitions),
+        "rmse": rmses[-1],
+        "best_iteration": best_iteration,
+        "predicts": [float(wins[t]) for t in order],
+        "actuals": [actual_wins[teams[t]] for t in order],
+        "rmses": rmses,
+    }
+
+calibration_modes = ["sample", "exact", "table", "solve"]
+
 def backpropagate_possessions(
-    schedule, actual_wins, meta, probs, simulate_game,
-    iterations=15, learn_rate=1.0
+    schedule, actual_wins, meta, probs, simulate_games=simulate_games,
+    iterations=15, learn_rate=1.0, rng=None, threshold_min=8, threshold_max=20,
+    decay=1.25, should_stop=None, mode="sample", crn_seed=None, antithetic=False
 ):
-    meta = copy.deepcopy(meta)
+    # crn_seed gives iteration i of every run the same per-game/possession draws (iteration_seed(crn_seed, i)),
+    # so runs with different settings are compared on common random numbers; antithetic averages each
+    # iteration's season with its mirror run on 1 - u. Both apply to the sample and table modes.
+    # The calibration state is a (team, location, start, outcome) tensor and a (team, location)
+    # possessions array; dicts are only built for the returned best meta and, as before, the final
+    # transition probabilities written back into probs. mode="solve" replaces the stochastic passes
+    # with solve_expected_wins and needs no learning rate; its fitted transitions are written back
+    # the same way.
+    if mode not in calibration_modes:
+        raise ValueError(f"Unknown mode {mode!r}; expected one of {calibration_modes}")
+    if mode == "solve":
+        fit = solve_expected_wins(schedule, actual_wins, meta, probs, max_iter=iterations, should_stop=should_stop)
+        write_transitions(probs, fit["teams"], fit["params"]["transitions"])
+        return fit["meta"], fit["rmse"], fit["best_iteration"], fit["predicts"], fit["actuals"], fit["rmses"]
+    rng = np.random.default_rng(rng)
+    teams = list(actual_wins)
+    actual = np.array([actual_wins[team] for team in teams])
+    season_schedule = compile_schedule(schedule, teams)
+    state = compile_team_params(probs, meta, teams)
+    start_probs, transitions, possessions = state["start_probs"], state["transitions"], state["possessions"]
+    if (crn_seed is not None or antithetic) and mode != "table" and possessions.max() > max_game_possessions:
+        raise ValueError(f"Common random numbers cover {max_game_possessions} possessions per game, "
+                         f"but the model starts with up to {possessions.max():.1f}")
     rmse = 15
     best_rmse = float("inf")
     best_iteration = 0
-    best_meta = None
+    best_possessions = None
     rmses = []
+    table = None
 
     for i in range(iterations):
-        records = {team: [0, 0] for team in actual_wins}
-
-        for idx, (gameid, homeTeam, awayTeam) in schedule.iterrows():
-            if sum(records[homeTeam]) > 81 or sum(records[awayTeam]) > 81:
-                continue
-
-            winner = simulate_game(
-                homeTeam, awayTeam, homeTeam,
-                probs[homeTeam], probs[awayTeam],
-                meta[homeTeam], meta[awayTeam]
-            )
-
-            if winner == homeTeam:
-                records[homeTeam][0] += 1
-                records[awayTeam][1] += 1
+        with instrument.span("simulation.backpropagate_possessions.iteration", iteration=i, mode=mode):
+            params = build_team_params(teams, start_probs, transitions, possessions)
+            uniforms = None
+            if crn_seed is not None or antithetic:
+                seed = iteration_seed(crn_seed, i) if crn_seed is not None else rng
+                n_games = len(season_schedule["home"])
+                uniforms = np.random.default_rng(seed).random(n_games) if mode == "table" else common_uniforms(seed, n_games)
+            if mode == "table":
+                table = build_matchup_table(params) if table is None else refresh_matchup_table(table, params)
+                wins, _ = sample_season_from_table(table, season_schedule, rng, uniforms)
+            elif mode == "exact":
+                wins, _ = expected_season_wins(params, season_schedule)
             else:
-                records[awayTeam][0] += 1
-                records[homeTeam][1] += 1
-
-        for team in records:
-            predicted_wins = records[team][0]
-            error = predicted_wins - actual_wins[team]
-            threshold = min(max(rmse * 1.5, 8), 20)
-            if abs(error) > threshold:
-                for loc in ["Home", "Away"]:
-                    for start in ["Defensive Rebound", "Steal", "Inbound"]:
-                        for outcome in ["2PT Made", "3PT Made", "Free Throw"]:
-                            probs[team][loc][outcome][start] *= (1 - error * learn_rate * 0.01)
-                        for outcome in ["Turnover", "2PT Missed", "3PT Missed"]:
-                            probs[team][loc][outcome][start] *= (1 + error * learn_rate * 0.01)
-    
-                # Normalize the transition matrix after modifying it
-                for loc in ["Home", "Away"]:
-                    transposed = flip_nested_dict(probs[team][loc])
-                    for start_type, outcomes in transposed.items():
-                        total = sum(outcomes.values())
-                        if total > 0:
-                            for outcome in outcomes:
-                                outcomes[outcome] /= total
-                    probs[team][loc] = flip_nested_dict(transposed)
-        
-                # Also tune possession counts
-                meta[team]["Home"]['avg_possessions_per_game'] -= error * learn_rate
-                meta[team]["Away"]['avg_possessions_per_game'] -= error * learn_rate
-
-
-        errors = [records[team][0] - actual_wins[team] for team in records]
-        rmse = np.sqrt(np.mean(np.square(errors)))
-        rmses.append(rmse)
-        learn_rate = 1 / (i + 2) ** 1.25
-
-        if rmse < best_rmse:
-            best_rmse = rmse
-            best_meta = copy.deepcopy(meta)
-            best_iteration = i
-
-    predicts = []
-    actuals = []
-    for team in sorted(records):
-        predicted = records[team][0]
-        actual = actual_wins[team]
-        predicts.append(predicted)
-        actuals.append(actual)
+                wins, _ = simulate_season(params, season_schedule, rng, simulate_games, uniforms)
+            if antithetic and mode != "exact":
+                mirror = (sample_season_from_table(table, season_schedule, rng, 1 - uniforms) if mode == "table"
+                          else simulate_season(params, season_schedule, rng, simulate_games, 1 - uniforms))
+                wins = (wins + mirror[0]) / 2
+            errors = wins - actual
+            threshold = min(max(rmse * 1.5, threshold_min), threshold_max)
+            transitions, possessions, over = calibration_step(transitions, possessions, errors, learn_rate, threshold)
+            if table is not None:
+                for t in np.flatnonzero(over):
+                    invalidate_matchups(table, t)
+            rmse = np.sqrt(np.mean(np.square(errors)))
+            rmses.append(rmse)
+            learn_rate = 1 / (i + 2) ** decay
+            if rmse < best_rmse:
+                best_rmse = rmse
+                best_possessions = possessions.copy()
+                best_iteration = i
+            if should_stop is not None and should_stop(i, rmses):
+                break
 
+    write_transitions(probs, teams, transitions)
+    best_meta = None if best_possessions is None else calibrated_meta(meta, teams, best_possessions)
+    order = sorted(range(len(teams)), key=lambda t: teams[t])
+    predicts = [wins[t].item() for t in order] if iterations else []
+    actuals = [actual_wins[teams[t]] for t in order] if iterations else []
     return best_meta, best_rmse, best_iteration, predicts, actuals, rmses 
 
-def run_simulation(iterations=15, learn_rate=1.0):
-    df = pd.read_csv("data/pbp_2023.csv")
-    schedule = (
-        df[["gameid", "homeTeam", "awayTeam"]]
+def load_schedule(season=2023):
+    df = storage.read_season(season, columns=["gameid", "homeTeam", "awayTeam"])
+    return (
+        df
         .drop_duplicates(subset=["gameid"])
         .reset_index(drop=True)
     )
-    
-    with open("team_metadata.json", "r") as f:
+
+def load_team_model(path="team_model.npz", teams=None):
+    # The arrays written by team_probabilities.write_team_model, reordered to this module's labels
+    with np.load(path) as model:
+        model_teams = [str(team) for team in model["teams"]]
+        teams = model_teams if teams is None else list(teams)
+        missing = [team for team in teams if team not in model_teams]
+        if missing:
+            raise KeyError(f"Teams {missing} are not in {path}")
+
+        t = [model_teams.index(team) for team in teams]
+        l = [list(model["locations"]).index(loc) for loc in locations]
+        s = [list(model["start_types"]).index(start) for start in start_types]
+        o = [list(model["outcome_types"]).index(outcome) for outcome in outcome_types]
+        start_probs = model["start_probs"][np.ix_(t, l, s)]
+        transitions = model["transitions"][np.ix_(t, l, s, o)]
+        possessions = model["possessions"][np.ix_(t, l)]
+    return build_team_params(teams, start_probs, transitions, possessions)
+
+def team_params_to_dicts(params):
+    # The (meta, probs) dicts backpropagate_possessions works on; start types the simulator never
+    # draws (jump balls) are not part of the model
+    meta, probs = {}, {}
+    for t, team in enumerate(params["teams"]):
+        meta[team], probs[team] = {}, {}
+        for l, loc in enumerate(locations):
+            meta[team][loc] = {
+                "avg_possessions_per_game": float(params["possessions"][t, l]),
+                "start_type_probs": {start: float(params["start_probs"][t, l, s]) for s, start in enumerate(start_types)},
+            }
+            probs[team][loc] = {
+                outcome: {start: float(params["transitions"][t, l, s, o]) for s, start in enumerate(start_types)}
+                for o, outcome in enumerate(outcome_types)
+            }
+    return meta, probs
+
+def load_team_inputs(metadata_path="team_metadata.json", matrices_path="team_matrices.json", model_path="team_model.npz"):
+    # The binary model is preferred; the JSON files remain as an export and a fallback
+    if model_path is not None and os.path.exists(model_path):
+        return team_params_to_dicts(load_team_model(model_path))
+
+    with open(metadata_path, "r") as f:
         meta = json.load(f)
-    
-    with open("team_matrices.json", "r") as f:
+
+    with open(matrices_path, "r") as f:
         probs = json.load(f)
-    
-    best_meta, best_rmse, best_iteration, predicts, actuals, rmses = backpropagate_possessions(schedule, actual_wins_2223, meta, probs, simulate_game, iterations=15, learn_rate=1.0)
+    return meta, probs
+
+def playoff_mask(wins, teams, rng, seeds=8):
+    # Top `seeds` of each conference per replicate; ties broken by a random draw
+    wins = np.atleast_2d(wins)
+    order_key = wins + rng.random(wins.shape)
+    made = np.zeros(wins.shape, dtype=bool)
+    for conference in [eastern_conference, western_conference]:
+        cols = np.array([teams.index(team) for team in conference if team in teams])
+        ranked = cols[np.argsort(-order_key[:, cols], axis=1)]
+        np.put_along_axis(made, ranked[:, :seeds], True, axis=1)
+    return made
+
+def summarize_replicates(wins, teams, rng, percentiles=(5, 25, 50, 75, 95), playoff_odds=True):
+    # playoff_odds is the top eight by wins in each conference, with no play-in
+    summary = pd.DataFrame({"mean_wins": wins.mean(axis=0), "std_wins": wins.std(axis=0)}, index=teams)
+    for q, values in zip(percentiles, np.percentile(wins, percentiles, axis=0)):
+        summary[f"p{q}"] = values
+    if playoff_odds:
+        summary["playoff_odds"] = playoff_mask(wins, teams, rng).mean(axis=0)
+    return summary
+
+_worker_state = {}
+
+def _init_replicate_worker(schedule, meta, probs, metadata_path, matrices_path, model_path):
+    # Runs once per worker process so the inputs are not re-read for every replicate
+    teams = list(actual_wins_2223)
+    if (meta is None or probs is None) and model_path is not None and os.path.exists(model_path):
+        _worker_state["params"] = load_team_model(model_path, teams)
+    else:
+        if meta is None or probs is None:
+            meta, probs = load_team_inputs(metadata_path, matrices_path, None)
+        _worker_state["params"] = compile_team_params(probs, meta, teams)
+    _worker_state["schedule"] = compile_schedule(schedule, teams)
+
+def _run_replicate_batch(seed_seqs):
+    params, season_schedule = _worker_state["params"], _worker_state["schedule"]
+    return np.stack([simulate_season(params, season_schedule, np.random.default_rng(ss))[0] for ss in seed_seqs])
+
+def simulate_replicates(replicate_seqs, max_workers=4, schedule=None, meta=None, probs=None,
+                        metadata_path="team_metadata.json", matrices_path="team_matrices.json",
+                        model_path="team_model.npz", batch_size=50):
+    # Wins per replicate (rows) and team (columns), one row per seed sequence in replicate_seqs
+    if schedule is None:
+        schedule = load_schedule()
+    if not replicate_seqs:
+        return np.zeros((0, len(actual_wins_2223)), dtype=int)
+    batches = [replicate_seqs[i:i + batch_size] for i in range(0, len(replicate_seqs), batch_size)]
+
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_replicate_worker,
+                             initargs=(schedule, meta, probs, metadata_path, matrices_path, model_path)) as executor:
+        return np.concatenate(list(executor.map(_run_replicate_batch, batches)))
+
+def run_replicates(n_replicates=1000, seed=None, max_workers=4, schedule=None, meta=None, probs=None,
+                   metadata_path="team_metadata.json", matrices_path="team_matrices.json",
+                   model_path="team_model.npz", batch_size=50):
+    teams = list(actual_wins_2223)
+
+    # One spawned stream per replicate, so results do not depend on how batches land on workers
+    seed_seq = np.random.SeedSequence(seed)
+    replicate_seqs = seed_seq.spawn(n_replicates)
+    wins = simulate_replicates(replicate_seqs, max_workers, schedule, meta, probs,
+                               metadata_path, matrices_path, model_path, batch_size)
+
+    tiebreak_rng = np.random.default_rng(seed_seq.spawn(1)[0])
+    return {
+        "teams": teams,
+        "wins": wins,
+        "summary": summarize_replicates(wins, teams, tiebreak_rng),
+        "entropy": seed_seq.entropy,
+    }
+
+def run_simulation(iterations=15, learn_rate=1.0, rng=None, mode="sample", crn_seed=None, antithetic=False):
+    schedule = load_schedule()
+    meta, probs = load_team_inputs()
+
+    best_meta, best_rmse, best_iteration, predicts, actuals, rmses = backpropagate_possessions(schedule, actual_wins_2223, meta, probs, simulate_games, iterations=iterations, learn_rate=learn_rate, rng=rng, mode=mode, crn_seed=crn_seed, antithetic=antithetic)
     return best_meta, best_rmse, best_iteration, predicts, actuals, rmses
\ No newline at end of file
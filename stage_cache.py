@@ -0,0 +1,68 @@
+import hashlib
+import json
+import os
+import sys
+import storage
+
+# One manifest per stage under data/cache, keyed by season. An entry is fresh while the input
+# file, the stage's source code and the output file all still hash to what was recorded.
+cache_dir = os.path.join(storage.data_dir, "cache")
+
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def code_version(*module_names):
+    # Editing any of the modules a stage runs invalidates every season of that stage
+    digest = hashlib.sha256()
+    for name in module_names:
+        module = sys.modules.get(name) or __import__(name)
+        with open(module.__file__, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+def manifest_path(stage, directory=None):
+    return os.path.join(directory or cache_dir, f"{stage}.json")
+
+def load_manifest(stage, directory=None):
+    path = manifest_path(stage, directory)
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_manifest(stage, manifest, directory=None):
+    path = manifest_path(stage, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(path + ".tmp", path)
+
+def is_fresh(manifest, season, input_path, output_path, code):
+    entry = manifest.get(str(season))
+    if entry is None or entry["code"] != code or entry["output"] != output_path:
+        return False
+    if not os.path.exists(input_path) or not os.path.exists(output_path):
+        return False
+    return entry["input_hash"] == file_hash(input_path) and entry["output_hash"] == file_hash(output_path)
+
+def record(manifest, season, input_path, output_path, code):
+    manifest[str(season)] = {
+        "input": input_path,
+        "input_hash": file_hash(input_path),
+        "output": output_path,
+        "output_hash": file_hash(output_path),
+        "code": code,
+    }
+    return manifest
+
+def stale_seasons(stage, seasons, input_path, output_path, code, force=False, directory=None):
+    # input_path and output_path map a season to its file; missing inputs are left to the stage to report
+    manifest = load_manifest(stage, directory)
+    if force:
+        return list(seasons), manifest
+    return [season for season in seasons
+            if not is_fresh(manifest, season, input_path(season), output_path(season), code)], manifest
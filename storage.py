@@ -0,0 +1,195 @@
+import os
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import instrument
+
+# Seasons are written as "{stage}_{season}.{ext}": year_processing writes the "clean" stage,
+# pbp_processing reads it and writes the "pbp" stage used by team_probabilities and simulation.
+data_dir = "data"
+default_format = os.environ.get("PBP_FORMAT", "parquet")
+formats = {"parquet": "parquet", "feather": "feather", "csv": "csv"}
+
+category_columns = ["eventType", "type", "subtype", "team", "homeTeam", "awayTeam", "possessionTeam"]
+float32_columns = ["x", "y"]
+int_columns = ["gameid"]
+
+# Strings pd.read_csv turns into NaN; the typed formats must read back the same values
+csv_na_strings = ["", "None", "NaN", "nan", "NA", "N/A", "NULL", "null"]
+
+# Streaming reads batch whole games so one batch stays under PBP_MAX_MEMORY bytes while it is
+# processed; the stages hold several working copies of a batch, hence the divisor
+default_max_memory = int(os.environ.get("PBP_MAX_MEMORY", 1 << 30))
+working_copies = 8
+
+# The CSV files always carried the frame index, which pbp_processing uses as EventIndex
+index_column = "Unnamed: 0"
+
+def season_path(season, stage="pbp", fmt=None, directory=None):
+    fmt = fmt or default_format
+    return os.path.join(directory or data_dir, f"{stage}_{season}.{formats[fmt]}")
+
+def find_season(season, stage="pbp", directory=None):
+    for fmt in formats:
+        path = season_path(season, stage, fmt, directory)
+        if os.path.exists(path):
+            return path, fmt
+    raise FileNotFoundError(f"No {stage} file for season {season} in {directory or data_dir}")
+
+def typed(df):
+    df = df.copy()
+    for col in df.columns:
+        if pd.api.types.is_object_dtype(df[col]) or pd.api.types.is_string_dtype(df[col]):
+            df[col] = df[col].where(~df[col].isin(csv_na_strings))
+    df = df.infer_objects()
+
+    for col in category_columns:
+        if col in df.columns:
+            df[col] = df[col].astype("category")
+    for col in float32_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col]).astype("float32")
+    for col in int_columns:
+        if col in df.columns and not df[col].isna().any():
+            df[col] = df[col].astype("int64")
+    return df
+
+def decategorize(df):
+    cats = [col for col in df.columns if isinstance(df[col].dtype, pd.CategoricalDtype)]
+    return df.astype({col: object for col in cats})
+
+def handoff(df, columns=None, categorical=True):
+    # The frame the next stage would get from write_season + read_season, without touching disk
+    df = typed(df.rename_axis(index_column).reset_index())
+    if columns is not None:
+        df = df[columns]
+    return df if categorical else decategorize(df)
+
+@instrument.step
+def write_season(df, season, stage="pbp", fmt=None, directory=None):
+    fmt = fmt or default_format
+    path = season_path(season, stage, fmt, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if fmt == "csv":
+        df.to_csv(path)
+        return path
+
+    df = typed(df.rename_axis(index_column).reset_index())
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    else:
+        df.to_feather(path)
+    return path
+
+def apply_filters(df, filters):
+    # The subset of pyarrow's filter syntax the pipeline uses: [(column, "==", "<=", ... or "in", value), ...]
+    comparisons = {"==": "eq", "!=": "ne", "<": "lt", "<=": "le", ">": "gt", ">=": "ge"}
+    for column, op, value in filters:
+        if op in comparisons:
+            df = df[getattr(df[column], comparisons[op])(value)]
+        elif op == "in":
+            df = df[df[column].isin(value)]
+        else:
+            raise ValueError(f"Unsupported filter operator {op!r}")
+    return df.reset_index(drop=True)
+
+@instrument.step
+def read_season(season, stage="pbp", columns=None, fmt=None, directory=None, categorical=True, filters=None):
+    if fmt is None:
+        path, fmt = find_season(season, stage, directory)
+    else:
+        path = season_path(season, stage, fmt, directory)
+
+    # Filtered columns have to be read even when the caller did not ask for them
+    read_columns = columns
+    if columns is not None and filters:
+        read_columns = columns + [column for column, _, _ in filters if column not in columns]
+
+    if fmt == "parquet":
+        df = pd.read_parquet(path, columns=read_columns, filters=filters)
+    elif fmt == "feather":
+        df = pd.read_feather(path, columns=read_columns)
+    else:
+        df = typed(pd.read_csv(path, usecols=read_columns))
+
+    if filters and fmt != "parquet":
+        df = apply_filters(df, filters)
+
+    if columns is not None:
+        df = df[columns]
+    return df if categorical else decategorize(df)
+
+def iter_games(path, max_memory=None, chunk_rows=10000):
+    # Yields frames of complete games from a raw season CSV, which must be in gameid order
+    max_memory = max_memory or default_max_memory
+    batch_rows = None
+    buffer = []
+    buffered_rows = 0
+    last_gameid = None
+    for chunk in pd.read_csv(path, chunksize=chunk_rows):
+        chunk = chunk.dropna(subset=["gameid"])
+        if len(chunk) == 0:
+            continue
+        gameids = chunk["gameid"].to_numpy()
+        if (last_gameid is not None and gameids[0] < last_gameid) or (gameids[1:] < gameids[:-1]).any():
+            raise ValueError(f"{path} is not sorted by gameid and cannot be streamed")
+        last_gameid = gameids[-1]
+
+        if batch_rows is None:
+            bytes_per_row = chunk.memory_usage(deep=True).sum() / len(chunk)
+            batch_rows = max(1, int(max_memory / (bytes_per_row * working_copies)))
+        buffer.append(chunk)
+        buffered_rows += len(chunk)
+        if buffered_rows < batch_rows:
+            continue
+
+        # Hold back the last game, it may continue in the next chunk
+        batch = pd.concat(buffer)
+        complete = batch["gameid"] != last_gameid
+        buffer = [batch[~complete]]
+        buffered_rows = len(buffer[0])
+        if complete.any():
+            yield batch[complete]
+
+    if buffered_rows:
+        yield pd.concat(buffer)
+
+@instrument.step
+def write_season_stream(frames, season, stage="pbp", fmt=None, directory=None):
+    # write_season for a sequence of frames; every frame after the first is cast to the first one's schema
+    fmt = fmt or default_format
+    path = season_path(season, stage, fmt, directory)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    if fmt == "csv":
+        with open(path, "w", newline="") as f:
+            for i, df in enumerate(frames):
+                df.to_csv(f, header=i == 0)
+        return path
+
+    if fmt == "feather":
+        # Feather has no incremental writer
+        return write_season(pd.concat(list(frames)), season, stage, fmt, directory)
+
+    writer = None
+    try:
+        for df in frames:
+            table = pa.Table.from_pandas(typed(df.rename_axis(index_column).reset_index()), preserve_index=False)
+            if writer is None:
+                schema = pa.schema([
+                    field.with_type(pa.dictionary(pa.int32(), field.type.value_type))
+                    if pa.types.is_dictionary(field.type) else field
+                    for field in table.schema
+                ], metadata=table.schema.metadata)
+                writer = pq.ParquetWriter(path, schema)
+            writer.write_table(table.cast(schema))
+    finally:
+        if writer is not None:
+            writer.close()
+    return path
+
+def export_csv(season, stage="pbp", directory=None):
+    df = read_season(season, stage, directory=directory).set_index(index_column)
+    df.index.name = None
+    return write_season(df, season, stage, "csv", directory)
@@ -2,11 +2,15 @@ import pandas as pd
 import numpy as np
 import seaborn as sns
 import matplotlib.pyplot as plt
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
-from tqdm import tqdm
 import time 
 import json
 from collections import defaultdict
+import storage
+import stage_cache
+import instrument
+import scheduler
+import os
+import pickle
 
 turnover_events = [
     "5 Second Violation", "8 Second Violation", "Bad Pass Turnover", "Double Dribble",
@@ -31,42 +35,47 @@ free_throw_events = [
     "Flagrant Foul Free Throw 2 of 2", "Flagrant Foul Free Throw 2 of 3", "Flagrant Foul Free Throw 3 of 3"
 ]
 
-def create_team_markov(group):
-    name, df = group
-    df = df.copy()
-
-    df["location"] = np.where(df["homeTeam"] == name, "Home", "Away")
-    df = df.dropna(subset=["possessionId"])
-
-    possession_grouped = df.groupby(["gameid", "possessionId", "location"])
-
-    transitions = []
-    start_counts = {"Home": defaultdict(int), "Away": defaultdict(int)}
-    possession_counts = {"Home": 0, "Away": 0}
-    games = {"Home": set(), "Away": set()}
-
-    for (gameid, poss_id, location), poss_df in possession_grouped:
-        start_event = poss_df.iloc[0]["eventType"]
-        end_event = poss_df.iloc[-1]["eventType"]
-
-        games[location].add(gameid)  # Track unique games
-
-        possession_counts[location] += 1
-        start_counts[location][start_event] += 1
-
-        if end_event in ["Inbound", "Defensive Rebound", "Steal", "Offensive Rebound", "Foul"]:
-            end_event = "Turnover"
-
-        transitions.append((location, start_event, end_event))
-
-    transitions_df = pd.DataFrame(transitions, columns=["location", "start", "end"])
-
-    transition_counts = (
-        transitions_df.groupby(["location", "start", "end"])
-        .size()
-        .reset_index(name="count")
-    )
-
+event_groups = {
+    **{event: "Turnover" for event in turnover_events},
+    **{event: "Free Throw" for event in free_throw_events},
+    **{event: "Foul" for event in foul_events},
+}
+
+markov_columns = ["gameid", "possessionId", "eventType", "homeTeam", "possessionTeam"]
+
+end_as_turnover = ["Inbound", "Defensive Rebound", "Steal", "Offensive Rebound", "Foul"]
+
+@instrument.step
+def possession_boundaries(df):
+    # One row per (team, game, possession): its location and first/last event, in the order a
+    # groupby over ["gameid", "possessionId", "location"] would visit each team's possessions
+    df = df.dropna(subset=["possessionTeam", "possessionId"])
+    team_codes, teams = pd.factorize(df["possessionTeam"], sort=True)
+    gameids = df["gameid"].to_numpy()
+    possession_ids = df["possessionId"].to_numpy()
+    order = np.lexsort((possession_ids, gameids, team_codes))
+
+    team_codes, gameids, possession_ids = team_codes[order], gameids[order], possession_ids[order]
+    events = df["eventType"].to_numpy(dtype=object)[order]
+    home = (df["homeTeam"].to_numpy(dtype=object)[order] == np.asarray(teams, dtype=object)[team_codes])
+
+    starts = np.ones(len(order), dtype=bool)
+    starts[1:] = ((team_codes[1:] != team_codes[:-1]) | (gameids[1:] != gameids[:-1]) |
+                  (possession_ids[1:] != possession_ids[:-1]))
+    first = np.flatnonzero(starts)
+    last = np.r_[first[1:], len(order)] - 1
+
+    end_events = events[last]
+    end_events = np.where(pd.Series(end_events).isin(end_as_turnover), "Turnover", end_events)
+    return pd.DataFrame({
+        "team": np.asarray(teams, dtype=object)[team_codes[first]],
+        "location": np.where(home[first], "Home", "Away"),
+        "gameid": gameids[first],
+        "start": events[first],
+        "end": end_events,
+    })
+
+def build_markov(transition_counts):
     markov = {"Home": {"Counts": {}, "Totals": {}}, "Away": {"Counts": {}, "Totals": {}}}
 
     for loc in ["Home", "Away"]:
@@ -74,72 +83,133 @@ def create_team_markov(group):
         pivot = df_loc.pivot(index="start", columns="end", values="count").fillna(0)
         totals = (pivot.T / pivot.sum(axis=1)).T.fillna(0)
         markov[loc]["Counts"] = pivot
-        markov[loc]["Totals"] = totals.loc[["Defensive Rebound", "Inbound", "Steal"], ["2PT Blocked", "2PT Made", "2PT Missed", "3PT Made", "3PT Missed", "Free Throw", "Turnover"]]
+        # Starts or outcomes a team never had (small samples) come through as zeros
+        markov[loc]["Totals"] = totals.reindex(index=["Defensive Rebound", "Inbound", "Steal"], columns=["2PT Blocked", "2PT Made", "2PT Missed", "3PT Made", "3PT Missed", "Free Throw", "Turnover"], fill_value=0)
+
+    return markov
+
+@instrument.step
+def create_season_markovs(df):
+    # Every team's Markov counts and metadata from one pass over the season's possessions
+    possessions = possession_boundaries(df)
+    transition_counts = possessions.groupby(["team", "location", "start", "end"]).size().reset_index(name="count")
+    possession_counts = possessions.groupby(["team", "location"]).size()
+    game_counts = possessions.groupby(["team", "location"])["gameid"].nunique()
+    start_counts = possessions.groupby(["team", "location", "start"], sort=False).size()
+
+    team_starts = defaultdict(lambda: {"Home": defaultdict(int), "Away": defaultdict(int)})
+    for (name, loc, start), count in start_counts.items():
+        team_starts[name][loc][start] = int(count)
+
+    results = {}
+    for name, team_transitions in transition_counts.groupby("team"):
+        results[name] = (
+            build_markov(team_transitions.drop(columns="team")),
+            {loc: int(possession_counts.get((name, loc), 0)) for loc in ["Home", "Away"]},
+            team_starts[name],
+            {loc: int(game_counts.get((name, loc), 0)) for loc in ["Home", "Away"]},
+        )
+    return results
 
-    return name, markov, possession_counts, start_counts, {loc: len(games[loc]) for loc in ["Home", "Away"]}
+def create_team_markov(group):
+    name, df = group
+    markov, possession_counts, start_counts, game_counts = create_season_markovs(df)[name]
+    return name, markov, possession_counts, start_counts, game_counts
 
-def generate_season_markovs(season):
-    df = pd.read_csv(f"data/pbp_{season}.csv")
+@instrument.step
+def prepare_markov_frame(df):
     df = df[((~df["eventType"].str.contains("Quarter")) & 
              (~df["eventType"].str.contains("Timeout")) & 
              (~df["eventType"].str.contains("Coach Challenge")) &
              (~df["eventType"].str.contains("Instant Replay")))]
 
-    df.loc[df["eventType"].isin(turnover_events), "eventType"] = "Turnover"
-    df.loc[df["eventType"].isin(free_throw_events), "eventType"] = "Free Throw"
-    df.loc[df["eventType"].isin(foul_events), "eventType"] = "Foul"
+    # map works on the categories of the stored column rather than on every row
+    df["eventType"] = df["eventType"].map(lambda event: event_groups.get(event, event))
+    return df
+
+def team_meta_entry(poss_counts, start_counts, game_counts):
+    # Possession and start counts for metadata
+    return {
+        "Home": {
+            "possessions": poss_counts["Home"],
+            "starts": dict(start_counts["Home"]),
+            "games": game_counts["Home"]
+        },
+        "Away": {
+            "possessions": poss_counts["Away"],
+            "starts": dict(start_counts["Away"]),
+            "games": game_counts["Away"]
+        }
+    }
+
+@instrument.step
+def generate_season_markovs(season):
+    return season_markovs_from_frame(season, storage.read_season(season, columns=markov_columns))
 
-    groups = df.groupby("possessionTeam")
+def season_markovs_from_frame(season, df):
     team_markovs = {}
     team_meta = {}
-
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(create_team_markov, group) for group in groups]
-        for f in as_completed(futures):
-            team, markov, poss_counts, start_counts, game_counts = f.result()
-            team_markovs[team] = markov
-
-            # Aggregate possession and start counts for metadata
-            team_meta[team] = {
-                "Home": {
-                    "possessions": poss_counts["Home"],
-                    "starts": dict(start_counts["Home"]),
-                    "games": game_counts["Home"]
-                },
-                "Away": {
-                    "possessions": poss_counts["Away"],
-                    "starts": dict(start_counts["Away"]),
-                    "games": game_counts["Away"]
-                }
-            }
-
-
+    for team, (markov, poss_counts, start_counts, game_counts) in create_season_markovs(prepare_markov_frame(df)).items():
+        team_markovs[team] = markov
+        team_meta[team] = team_meta_entry(poss_counts, start_counts, game_counts)
     return season, team_markovs, team_meta
 
-def parallel_main():
+def markov_cache_path(season):
+    return os.path.join(stage_cache.cache_dir, f"markov_{season}.pkl")
+
+def add_season_meta(meta, team_meta):
+    for team in team_meta:
+        if team not in meta:
+            meta[team] = {"Home": {"possessions": 0, "starts": defaultdict(int), "games": 0},
+                          "Away": {"possessions": 0, "starts": defaultdict(int), "games": 0}}
+        meta[team]["Home"]["possessions"] += team_meta[team]["Home"]["possessions"]
+        meta[team]["Away"]["possessions"] += team_meta[team]["Away"]["possessions"]
+        meta[team]["Home"]["games"] += team_meta[team]["Home"]["games"]
+        meta[team]["Away"]["games"] += team_meta[team]["Away"]["games"]
+
+        for k, v in team_meta[team]["Home"]["starts"].items():
+            meta[team]["Home"]["starts"][k] += v
+        for k, v in team_meta[team]["Away"]["starts"].items():
+            meta[team]["Away"]["starts"][k] += v
+    return meta
+
+def parallel_main(force=False, max_workers=None):
     seasons = list(range(2015, 2023))
     markovs = {}
     meta = {}
 
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(generate_season_markovs, season) for season in seasons]
-        for f in tqdm(as_completed(futures), total=len(futures), desc="Seasons"):
-            season, team_markovs, team_meta = f.result()
-            markovs[season] = team_markovs
-
-            for team in team_meta:
-                if team not in meta:
-                    meta[team] = {"Home": {"possessions": 0, "starts": defaultdict(int), "games": 0},
-                                  "Away": {"possessions": 0, "starts": defaultdict(int), "games": 0}}
-                meta[team]["Home"]["possessions"] += team_meta[team]["Home"]["possessions"]
-                meta[team]["Away"]["possessions"] += team_meta[team]["Away"]["possessions"]
-                meta[team]["Home"]["games"] += team_meta[team]["Home"]["games"]
-                meta[team]["Away"]["games"] += team_meta[team]["Away"]["games"]
-
-                for k, v in team_meta[team]["Home"]["starts"].items():
-                    meta[team]["Home"]["starts"][k] += v
-                for k, v in team_meta[team]["Away"]["starts"].items():
-                    meta[team]["Away"]["starts"][k] += v
+    # Per-season results are pickled and reused while the pbp file and this module are unchanged
+    code = stage_cache.code_version("team_probabilities", "storage")
+    input_path = lambda season: storage.season_path(season, stage="pbp")
+    stale, manifest = stage_cache.stale_seasons("markov", seasons, input_path, markov_cache_path, code, force)
+
+    results = {}
+    for season in seasons:
+        if season not in stale:
+            with open(markov_cache_path(season), "rb") as f:
+                results[season] = pickle.load(f)
+
+    def on_result(season, result):
+        results[season] = result
+        os.makedirs(stage_cache.cache_dir, exist_ok=True)
+        with open(markov_cache_path(season), "wb") as out:
+            pickle.dump(result, out)
+        stage_cache.record(manifest, season, input_path(season), markov_cache_path(season), code)
+        stage_cache.save_manifest("markov", manifest)
+
+    tasks = [scheduler.task(season, generate_season_markovs, season, size=scheduler.file_size(input_path(season)))
+             for season in stale]
+    _, timings = scheduler.run_tasks(tasks, max_workers, desc="Seasons", on_result=on_result,
+                                     timings_path="logs/team_probabilities_timings.csv")
+    scheduler.report_timings(timings, desc="Seasons")
+    missing = [season for season in stale if season not in results]
+    if missing:
+        raise RuntimeError(f"Markov builds failed for seasons {missing}")
+
+    for season in seasons:
+        _, team_markovs, team_meta = results[season]
+        markovs[season] = team_markovs
+        add_season_meta(meta, team_meta)
 
     return markovs, meta
 
@@ -188,8 +258,34 @@ def convert_meta_to_probs(meta):
 
     return meta_out
 
+model_locations = ["Home", "Away"]
+model_starts = ["Defensive Rebound", "Inbound", "Steal"]
+model_outcomes = ["2PT Blocked", "2PT Made", "2PT Missed", "3PT Made", "3PT Missed", "Free Throw", "Turnover"]
+
+def write_team_model(path, team_matrices, team_metadata):
+    # Dense teams x locations x starts x outcomes arrays plus their labels, read by simulation.load_team_model
+    teams = sorted(team_matrices)
+    start_probs = np.zeros((len(teams), len(model_locations), len(model_starts)))
+    transitions = np.zeros((len(teams), len(model_locations), len(model_starts), len(model_outcomes)))
+    possessions = np.zeros((len(teams), len(model_locations)))
+
+    for t, team in enumerate(teams):
+        for l, loc in enumerate(model_locations):
+            possessions[t, l] = team_metadata[team][loc]["avg_possessions_per_game"]
+            for s, start in enumerate(model_starts):
+                start_probs[t, l, s] = team_metadata[team][loc]["start_type_probs"].get(start, 0)
+                for o, outcome in enumerate(model_outcomes):
+                    transitions[t, l, s, o] = team_matrices[team][loc].get(outcome, {}).get(start, 0)
+
+    np.savez(path, teams=np.array(teams), locations=np.array(model_locations),
+             start_types=np.array(model_starts), outcome_types=np.array(model_outcomes),
+             start_probs=start_probs, transitions=transitions, possessions=possessions)
+    return path
+
 if __name__ == "__main__":
     start_time = time.time()
+    if instrument.enabled:
+        instrument.reset()
     markovs, meta = parallel_main()
 
     team_matrices = average_markov_matrices(markovs)
@@ -201,4 +297,8 @@ if __name__ == "__main__":
     with open("team_metadata.json", "w") as f:
         json.dump(team_metadata, f, indent=2)
 
+    write_team_model("team_model.npz", team_matrices, team_metadata)
+
     print("Done in", round(time.time() - start_time, 2), "seconds.")
+    if instrument.enabled:
+        instrument.report()
@@ -8,11 +8,13 @@ Created on Mon Mar 31 14:37:57 2025
 import kagglehub
 import pandas as pd
 import numpy as np
-from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
-from tqdm import tqdm
 import time
 from numba import njit
 import os
+import storage
+import stage_cache
+import instrument
+import scheduler
 os.makedirs("./data", exist_ok=True)
 
 TEAM_NAME_TO_ABBR = {
@@ -52,10 +54,13 @@ TEAM_NAME_TO_ABBR = {
     "NETS": "BKN",      
 }
 
-@njit
-def iterate_indices_pts(indices, home_pts, away_pts):
+@njit(cache=True)
+def iterate_indices_pts(game_starts, home_pts, away_pts):
     home_last_seen_data, away_last_seen_data = 0, 0
-    for ind in indices:
+    for ind in range(len(home_pts)):
+        if game_starts[ind]:
+            home_last_seen_data, away_last_seen_data = 0, 0
+
         if np.isnan(home_pts[ind]) or home_pts[ind] < home_last_seen_data:
             home_pts[ind] = home_last_seen_data
         else:
@@ -68,123 +73,169 @@ def iterate_indices_pts(indices, home_pts, away_pts):
         
     return home_pts, away_pts
 
-def iterate_indices_def(ind, types, desc):
-    if not isinstance(types[ind], str):
-        if isinstance(desc[ind], str): 
-             if "BLOCK" in desc[ind]:
-                 types[ind] = "Block"
-             elif "STEAL" in desc[ind]:
-                 types[ind] = "Steal"
-    return types
-
-def iterate_indices_reb(ind, types, types_prev, subtypes, players, desc, plyr_rebounds, teams):
-    if types[ind] == "Rebound":
-        # Track player rebounds
-        if players[ind] not in plyr_rebounds:
-            plyr_rebounds[players[ind]] = [0, 0]  # [off_reb, def_reb]
-
-        # 🧠 Case 1: desc includes rebound counts → easy parse
-        if isinstance(desc[ind], str) and ":" in desc[ind]:
-            split = desc[ind].split(":")
-            off_reb = int(split[1].split(" ")[0])
-            if plyr_rebounds[players[ind]][0] < off_reb:
-                subtypes[ind] = "Offensive"
-                plyr_rebounds[players[ind]][0] += 1
+@njit(cache=True)
+def iterate_indices_reb(game_starts, game_ends, is_rebound, reb_case, off_reb, player_codes,
+                        reb_team_codes, team_codes, is_shot, prev_is_shot):
+    n = len(game_starts)
+
+    # Team of the last row whose previous row was a shot (the original lookup used the
+    # shifted type column), and team of the next shot; -2 when there is none in the game
+    prev_shot_team = np.full(n, -2, dtype=np.int64)
+    last_team = -2
+    for ind in range(n):
+        if game_starts[ind]:
+            last_team = -2
+        prev_shot_team[ind] = last_team
+        if prev_is_shot[ind]:
+            last_team = team_codes[ind]
+
+    next_shot_team = np.full(n, -2, dtype=np.int64)
+    next_team = -2
+    for ind in range(n - 1, -1, -1):
+        next_shot_team[ind] = next_team
+        if is_shot[ind]:
+            next_team = team_codes[ind]
+        # After the shot update, so a game's opening shot does not carry back into the previous game
+        if game_starts[ind]:
+            next_team = -2
+
+    # 0 keeps the subtype, 1 is Offensive, 2 is Defensive
+    subtypes = np.zeros(n, dtype=np.int64)
+    off_rebounds = np.zeros(player_codes.max() + 1 if n else 0, dtype=np.int64)
+    for ind in range(n):
+        if not is_rebound[ind]:
+            continue
+        if reb_case[ind] == 1:
+            # Case 1: desc includes the player's rebound counts
+            if off_rebounds[player_codes[ind]] < off_reb[ind]:
+                subtypes[ind] = 1
+                off_rebounds[player_codes[ind]] += 1
             else:
-                subtypes[ind] = "Defensive"
-                plyr_rebounds[players[ind]][1] += 1
-
-        # 🧠 Case 2: rebound by team name (not player)
-        elif isinstance(desc[ind], str) and desc[ind].split(" ")[0].upper() in TEAM_NAME_TO_ABBR:
-            teamname = desc[ind].split(" ")[0]
-            reb_team = TEAM_NAME_TO_ABBR.get(teamname.upper(), None)
-            if reb_team is not None and ind > 0:
-                # Look backward to find last shot team
-                for prev_ind in range(ind - 1, -1, -1):
-                    if types_prev[prev_ind] in {"Missed Shot", "Made Shot"}:
-                        shooting_team = teams[prev_ind]
-                        break
-                else:
-                    shooting_team = None
-
-                if reb_team == shooting_team:
-                    subtypes[ind] = "Offensive"
-                else:
-                    subtypes[ind] = "Defensive"
-
-        # 🧠 Case 3: unknown desc — deduce from next shot team
-        else:
-            if ind + 1 < len(types):
-                for future_ind in range(ind + 1, len(types)):
-                    if types[future_ind] in {"Missed Shot", "Made Shot"}:
-                        next_shooting_team = teams[future_ind]
-                        break
-                else:
-                    next_shooting_team = None
-
-                # Assume team that got rebound ≠ next shooter → defensive
-                if teams[ind] != next_shooting_team:
-                    subtypes[ind] = "Defensive"
-                else:
-                    subtypes[ind] = "Offensive"
-    
-    return subtypes, plyr_rebounds
-
-def iterate_indices_jumpball(ind, types, results, teams):
-    if types[ind] == "Jump Ball":
-        if ind + 1 < len(teams):
-            results[ind] = teams[ind + 1]
-        else:
-            results[ind] = "End of Game"
-    return results 
-
-def iterate_indices(indices, types, prev_types, subtypes, results, players, teams, desc):
-    plyr_rebounds = {}
-    types, prev_types, subtypes, results, players, teams, desc = list(types), list(prev_types), list(subtypes), list(results), list(players), list(teams), list(desc)
-    for ind in indices:
-        types = iterate_indices_def(ind, types, desc)
-        subtypes, plyr_rebounds = iterate_indices_reb(ind, types, prev_types,  subtypes, players, desc, plyr_rebounds, teams)
-        results = iterate_indices_jumpball(ind, types, results, teams)
+                subtypes[ind] = 2
+        elif reb_case[ind] == 2:
+            # Case 2: team rebound, offensive if the same team took the last shot
+            if not game_starts[ind]:
+                same = reb_team_codes[ind] >= 0 and reb_team_codes[ind] == prev_shot_team[ind]
+                subtypes[ind] = 1 if same else 2
+        elif not game_ends[ind]:
+            # Case 3: unknown desc, offensive if the rebounding team also takes the next shot
+            same = team_codes[ind] >= 0 and team_codes[ind] == next_shot_team[ind]
+            subtypes[ind] = 1 if same else 2
+    return subtypes
+
+@instrument.step
+def iterate_indices(game_starts, game_ends, types, subtypes, results, players, teams, desc):
+    shots = ["Missed Shot", "Made Shot"]
+    is_shot = types.isin(shots).to_numpy()
+    prev_is_shot = np.zeros_like(is_shot)
+    prev_is_shot[1:] = is_shot[:-1]
+    prev_is_shot &= ~game_starts
+
+    # Blocks and steals come through as rows without a type
+    is_block = types.isna().to_numpy() & desc.str.contains("BLOCK", regex=False, na=False).to_numpy()
+    is_steal = types.isna().to_numpy() & ~is_block & desc.str.contains("STEAL", regex=False, na=False).to_numpy()
+
+    # Rebound descriptions are only parsed on rebound rows, once each
+    is_rebound = (types == "Rebound").to_numpy()
+    reb_desc = desc[is_rebound]
+    has_counts = reb_desc.str.contains(":", regex=False, na=False).to_numpy()
+    reb_team = reb_desc.str.split(" ", n=1).str[0].str.upper().map(TEAM_NAME_TO_ABBR)
+    reb_case = np.zeros(len(types), dtype=np.int64)
+    reb_case[is_rebound] = np.select([has_counts, reb_team.notna().to_numpy()], [1, 2], 3)
+
+    off_reb = np.zeros(len(types), dtype=np.int64)
+    off_reb[reb_case == 1] = reb_desc[has_counts].str.split(":").str[1].str.split(" ").str[0].astype("int64").to_numpy()
+
+    game_ids = np.cumsum(game_starts)
+    player_codes = np.zeros(len(types), dtype=np.int64)
+    player_codes[is_rebound], _ = pd.factorize(pd.Series(list(zip(game_ids[is_rebound], players[is_rebound]))), use_na_sentinel=False)
+    codes, _ = pd.factorize(pd.concat([teams, reb_team]))
+    team_codes = codes[:len(types)]
+    reb_team_codes = np.full(len(types), -1, dtype=np.int64)
+    reb_team_codes[is_rebound] = codes[len(types):]
+
+    reb_subtypes = iterate_indices_reb(game_starts, game_ends, is_rebound, reb_case, off_reb,
+                                       player_codes, reb_team_codes, team_codes, is_shot, prev_is_shot)
+
+    is_jumpball = (types == "Jump Ball").to_numpy()
+    next_team = np.where(game_ends, "End of Game", teams.shift(-1).to_numpy(dtype=object))
+
+    types = np.select([is_block, is_steal], ["Block", "Steal"], types.to_numpy(dtype=object))
+    subtypes = np.select([reb_subtypes == 1, reb_subtypes == 2], ["Offensive", "Defensive"], subtypes.to_numpy(dtype=object))
+    results = np.where(is_jumpball, next_team, results.to_numpy(dtype=object))
     return types, subtypes, results
 
-def process_group(gameId, group):
-    indices = np.arange(0, len(group), 1)
-    h_pts, a_pts = iterate_indices_pts(indices, np.array(group["h_pts"]), np.array(group["a_pts"]))
-    types, subtypes, results = iterate_indices(indices, group["type"], group["type"].shift(1),  group['subtype'],  group["result"], group["player"], group["team"], group["desc"])
+@instrument.step
+def process_games(df):
+    # All games at once, in the order groupby("gameid") would visit them
+    df = df.dropna(subset=["gameid"])
+    df = df.iloc[np.argsort(df["gameid"].to_numpy(), kind="stable")].copy()
+    gameids = df["gameid"].to_numpy()
+    game_starts = np.ones(len(df), dtype=bool)
+    game_starts[1:] = gameids[1:] != gameids[:-1]
+    game_ends = np.ones(len(df), dtype=bool)
+    game_ends[:-1] = game_starts[1:]
+
+    h_pts, a_pts = iterate_indices_pts(game_starts, np.array(df["h_pts"]), np.array(df["a_pts"]))
+    types, subtypes, results = iterate_indices(game_starts, game_ends, df["type"], df["subtype"], df["result"],
+                                               df["player"], df["team"], df["desc"])
+
+    df.loc[:, "h_pts"] = h_pts
+    df.loc[:, "a_pts"] = a_pts
+    df.loc[:, "type"] = types
+    df.loc[:, "subtype"] = subtypes
+    df.loc[:, "result"] = results
+
+    df = df.fillna("None")
+    return df
 
-    group.loc[:, "h_pts"] = h_pts
-    group.loc[:, "a_pts"] = a_pts
-    group.loc[:, "type"] = types
-    group.loc[:, "subtype"] = subtypes
-    group.loc[:, "result"] = results
-
-    group = group.fillna("None")
-    return group
+def process_group(gameId, group):
+    return process_games(group)
 
-def parallel_process_season(path, year):
-    df = pd.read_csv(path + f'/pbp{year}.csv')
-    
+@instrument.step
+def clean_season(df):
     df["minutes_remaining"] = (df["clock"].apply(lambda x: x.split("PT")[1].split("M")[0])).astype("int64")
     df["seconds_remaining"] = (df["clock"].apply(lambda x: x.split("M")[1].split("S")[0])).astype("float64")
     df = df.drop("clock", axis=1)
-    
-    groups = df.groupby("gameid")
-    results = []
-    with ThreadPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(process_group, gid, grp) for gid, grp in groups]
-        for f in as_completed(futures):
-            results.append(f.result())
-    pd.concat(results, axis=0).to_csv(f"./data/pbp_{year}.csv") 
-
-def parallel_main():
+    return process_games(df)
+
+@instrument.step
+def parallel_process_season(path, year):
+    with instrument.span("year_processing.read_csv") as info:
+        df = pd.read_csv(path + f'/pbp{year}.csv')
+        info["rows_out"] = len(df)
+    storage.write_season(clean_season(df), year, stage="clean")
+
+def stream_season(path, year, max_memory=None):
+    # Cleaned batches of complete games, without holding the raw season in memory
+    for batch in storage.iter_games(path + f'/pbp{year}.csv', max_memory):
+        yield clean_season(batch)
+
+def parallel_main(force=False, max_workers=None):
     path = kagglehub.dataset_download("szymonjwiak/nba-play-by-play-data-1997-2023")
     years = list(range(1997, 2024))
-    with ProcessPoolExecutor(max_workers=4) as executor:
-        futures = [executor.submit(parallel_process_season, path, year) for year in years]
-        for f in tqdm(as_completed(futures), total=len(futures), desc="Seasons"):
-            pass 
+
+    # Only seasons whose raw file or this stage's code changed since the last run are reprocessed
+    code = stage_cache.code_version("year_processing", "storage")
+    input_path = lambda year: path + f'/pbp{year}.csv'
+    output_path = lambda year: storage.season_path(year, stage="clean")
+    years, manifest = stage_cache.stale_seasons("clean", years, input_path, output_path, code, force)
+
+    def on_result(year, result):
+        stage_cache.record(manifest, year, input_path(year), output_path(year), code)
+        stage_cache.save_manifest("clean", manifest)
+
+    tasks = [scheduler.task(year, parallel_process_season, path, year, size=scheduler.file_size(input_path(year)))
+             for year in years]
+    _, timings = scheduler.run_tasks(tasks, max_workers, desc="Seasons", on_result=on_result,
+                                     timings_path="logs/year_processing_timings.csv")
+    scheduler.report_timings(timings, desc="Seasons")
 
 if __name__ == "__main__":
    start_time = time.time()
+   if instrument.enabled:
+       instrument.reset()
    parallel_main()
    print(time.time() - start_time)
+   if instrument.enabled:
+       instrument.report()
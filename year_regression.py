@@ -0,0 +1,165 @@
+import io
+import sys
+import numpy as np
+import pandas as pd
+from numba import njit
+import year_processing
+from year_processing import TEAM_NAME_TO_ABBR
+
+# Per-game, row-by-row implementation that year_processing replaced with season-wide array passes.
+# It is kept here only so the compiled classifier can be checked against it season by season.
+
+@njit
+def legacy_iterate_indices_pts(indices, home_pts, away_pts):
+    home_last_seen_data, away_last_seen_data = 0, 0
+    for ind in indices:
+        if np.isnan(home_pts[ind]) or home_pts[ind] < home_last_seen_data:
+            home_pts[ind] = home_last_seen_data
+        else:
+            home_last_seen_data = home_pts[ind]
+        
+        if np.isnan(away_pts[ind]) or away_pts[ind] < away_last_seen_data:
+            away_pts[ind] = away_last_seen_data
+        else:
+            away_last_seen_data = away_pts[ind]
+        
+    return home_pts, away_pts
+
+def legacy_iterate_indices_def(ind, types, desc):
+    if not isinstance(types[ind], str):
+        if isinstance(desc[ind], str): 
+             if "BLOCK" in desc[ind]:
+                 types[ind] = "Block"
+             elif "STEAL" in desc[ind]:
+                 types[ind] = "Steal"
+    return types
+
+def legacy_iterate_indices_reb(ind, types, types_prev, subtypes, players, desc, plyr_rebounds, teams):
+    if types[ind] == "Rebound":
+        # Track player rebounds
+        if players[ind] not in plyr_rebounds:
+            plyr_rebounds[players[ind]] = [0, 0]  # [off_reb, def_reb]
+
+        # 🧠 Case 1: desc includes rebound counts → easy parse
+        if isinstance(desc[ind], str) and ":" in desc[ind]:
+            split = desc[ind].split(":")
+            off_reb = int(split[1].split(" ")[0])
+            if plyr_rebounds[players[ind]][0] < off_reb:
+                subtypes[ind] = "Offensive"
+                plyr_rebounds[players[ind]][0] += 1
+            else:
+                subtypes[ind] = "Defensive"
+                plyr_rebounds[players[ind]][1] += 1
+
+        # 🧠 Case 2: rebound by team name (not player)
+        elif isinstance(desc[ind], str) and desc[ind].split(" ")[0].upper() in TEAM_NAME_TO_ABBR:
+            teamname = desc[ind].split(" ")[0]
+            reb_team = TEAM_NAME_TO_ABBR.get(teamname.upper(), None)
+            if reb_team is not None and ind > 0:
+                # Look backward to find last shot team
+                for prev_ind in range(ind - 1, -1, -1):
+                    if types_prev[prev_ind] in {"Missed Shot", "Made Shot"}:
+                        shooting_team = teams[prev_ind]
+                        break
+                else:
+                    shooting_team = None
+
+                if reb_team == shooting_team:
+                    subtypes[ind] = "Offensive"
+                else:
+                    subtypes[ind] = "Defensive"
+
+        # 🧠 Case 3: unknown desc — deduce from next shot team
+        else:
+            if ind + 1 < len(types):
+                for future_ind in range(ind + 1, len(types)):
+                    if types[future_ind] in {"Missed Shot", "Made Shot"}:
+                        next_shooting_team = teams[future_ind]
+                        break
+                else:
+                    next_shooting_team = None
+
+                # Assume team that got rebound ≠ next shooter → defensive
+                if teams[ind] != next_shooting_team:
+                    subtypes[ind] = "Defensive"
+                else:
+                    subtypes[ind] = "Offensive"
+    
+    return subtypes, plyr_rebounds
+
+def legacy_iterate_indices_jumpball(ind, types, results, teams):
+    if types[ind] == "Jump Ball":
+        if ind + 1 < len(teams):
+            results[ind] = teams[ind + 1]
+        else:
+            results[ind] = "End of Game"
+    return results 
+
+def legacy_iterate_indices(indices, types, prev_types, subtypes, results, players, teams, desc):
+    plyr_rebounds = {}
+    types, prev_types, subtypes, results, players, teams, desc = list(types), list(prev_types), list(subtypes), list(results), list(players), list(teams), list(desc)
+    for ind in indices:
+        types = legacy_iterate_indices_def(ind, types, desc)
+        subtypes, plyr_rebounds = legacy_iterate_indices_reb(ind, types, prev_types,  subtypes, players, desc, plyr_rebounds, teams)
+        results = legacy_iterate_indices_jumpball(ind, types, results, teams)
+    return types, subtypes, results
+
+def legacy_process_group(gameId, group):
+    indices = np.arange(0, len(group), 1)
+    h_pts, a_pts = legacy_iterate_indices_pts(indices, np.array(group["h_pts"]), np.array(group["a_pts"]))
+    types, subtypes, results = legacy_iterate_indices(indices, group["type"], group["type"].shift(1),  group['subtype'],  group["result"], group["player"], group["team"], group["desc"])
+
+    group.loc[:, "h_pts"] = h_pts
+    group.loc[:, "a_pts"] = a_pts
+    group.loc[:, "type"] = types
+    group.loc[:, "subtype"] = subtypes
+    group.loc[:, "result"] = results
+
+    group = group.fillna("None")
+    return group
+
+def run_legacy(df):
+    return pd.concat([legacy_process_group(gid, grp.copy()) for gid, grp in df.groupby("gameid")], axis=0)
+
+def boundary_games():
+    # Games the raw seasons may not happen to contain: the first ends on an unlabelled rebound with
+    # no shot after it in that game, and the next opens with a shot by the rebounding team
+    columns = ["gameid", "h_pts", "a_pts", "team", "player", "type", "subtype", "result", "desc"]
+    rows = [
+        [1, 0, 0, "BOS", "A", "Missed Shot", "Jump Shot", "Missed", "MISS A Jump Shot"],
+        [1, None, None, "BOS", "B", "Rebound", None, None, "B REBOUND"],
+        [1, None, None, "BOS", None, "Timeout", "Regular", None, "Timeout"],
+        [2, 2, 0, "BOS", "A", "Made Shot", "Jump Shot", "Made", "A Jump Shot (2 PTS)"],
+        [2, None, None, "NYK", "C", "Missed Shot", "Jump Shot", "Missed", "MISS C Jump Shot"],
+        [2, None, None, "NYK", "C", "Rebound", None, None, "C REBOUND"],
+        [2, None, None, "NYK", "C", "Made Shot", "Layup", "Made", "C Layup (2 PTS)"],
+    ]
+    # Through CSV so the dtypes match a raw season file
+    return pd.read_csv(io.StringIO(pd.DataFrame(rows, columns=columns).to_csv(index=False)))
+
+def compare_frames(df):
+    new = year_processing.process_games(df.copy()).to_csv()
+    old = run_legacy(df.copy()).to_csv()
+    if new == old:
+        return True, None
+
+    new_lines, old_lines = new.splitlines(), old.splitlines()
+    for line, (a, b) in enumerate(zip(new_lines, old_lines)):
+        if a != b:
+            return False, (line, a, b)
+    return False, (min(len(new_lines), len(old_lines)), len(new_lines), len(old_lines))
+
+def compare_season(path, season):
+    return (season, *compare_frames(pd.read_csv(path + f"/pbp{season}.csv")))
+
+if __name__ == "__main__":
+    path = sys.argv[1]
+    seasons = [int(s) for s in sys.argv[2:]] or list(range(1997, 2024))
+    same, diff = compare_frames(boundary_games())
+    print("boundary games", "identical" if same else f"DIFFERS at {diff}")
+    failed = not same
+    for season in seasons:
+        season, same, diff = compare_season(path, season)
+        print(season, "identical" if same else f"DIFFERS at {diff}")
+        failed = failed or not same
+    sys.exit(1 if failed else 0)